@@ -0,0 +1,178 @@
+"""
+Sorted CDXJ indexes for the WARC archive, in the compressed ZipNum layout.
+
+A CDXJ line is a SURT-ordered URL key, a 14-digit timestamp, and a JSON
+block with the rest of the capture fields:
+
+    org,example)/index.gmi 20201107000000 {"url": "gemini://example.org/index.gmi", ...}
+
+The lines are written in blocks of a few thousand, and each block is
+compressed as its own gzip member. The members are concatenated into a single
+.cdxj.gz file that can still be read with zcat. A small secondary .idx file
+holds the first key of every block along with its byte range, so a lookup is a
+binary search over the secondary index (which is kept in memory) followed by
+decompressing one or two blocks.
+"""
+import bisect
+import gzip
+import json
+import pathlib
+import re
+import zlib
+from urllib.parse import urlsplit
+
+from .urls import DEFAULT_PORTS, canonicalize_url
+
+# Number of CDXJ lines in each compressed block, this is the same as pywb
+BLOCK_SIZE = 3000
+
+RE_NON_DIGIT = re.compile('[^0-9]')
+
+
+def surt(url):
+    """
+    Build the sort-friendly URI reordering transform (SURT) key for a URL.
+
+    The hostname labels are reversed so that all of the URLs for a domain
+    and its subdomains sort next to each other. The scheme is dropped and the
+    port is only kept if it's not the default. Unlike web archives, "www." is
+    not stripped because it's usually a different capsule in geminispace.
+    """
+    url = canonicalize_url(url)
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    host = parts.hostname or ''
+    key = ','.join(reversed(host.split('.')))
+    if port is not None and port != DEFAULT_PORTS.get(parts.scheme):
+        key += f':{port}'
+
+    key += ')' + (parts.path or '/')
+    if parts.query:
+        key += '?' + parts.query
+    return key
+
+
+def iso_date_to_timestamp(warc_date):
+    """
+    Convert a WARC-Date like 2020-11-07T00:00:00.123Z to 20201107000000.
+    """
+    return RE_NON_DIGIT.sub('', warc_date)[:14]
+
+
+def format_line(key, timestamp, fields):
+    return f'{key} {timestamp} {json.dumps(fields, separators=(",", ":"))}\n'
+
+
+def parse_line(line):
+    key, timestamp, fields = line.split(' ', 2)
+    fields = json.loads(fields)
+    fields['urlkey'] = key
+    fields['timestamp'] = timestamp
+    return fields
+
+
+class ZipNumWriter:
+    """
+    Write pre-sorted CDXJ lines to a ZipNum compressed index.
+    """
+
+    def __init__(self, cdxj_path, idx_path, block_size=BLOCK_SIZE):
+        self.cdxj_path = pathlib.Path(cdxj_path)
+        self.idx_path = pathlib.Path(idx_path)
+        self.block_size = block_size
+
+        self.cdxj_fp = open(cdxj_path, 'wb')
+        self.idx_fp = open(idx_path, 'w')
+        self.block = []
+        self.blocks = 0
+        self.lines = 0
+        self.last_key = None
+
+    def write(self, line):
+        key = line.split(' {', 1)[0]
+        if self.last_key is not None and key < self.last_key:
+            raise ValueError(f'CDXJ lines must be sorted: {line!r}')
+        self.last_key = key
+
+        self.block.append(line)
+        self.lines += 1
+        if len(self.block) >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self):
+        if not self.block:
+            return
+
+        first_key = self.block[0].split(' {', 1)[0]
+        data = gzip.compress(''.join(self.block).encode('utf-8'))
+        offset = self.cdxj_fp.tell()
+        self.cdxj_fp.write(data)
+        self.blocks += 1
+        self.idx_fp.write(f'{first_key}\t{self.cdxj_path.name}\t{offset}\t{len(data)}\t{self.blocks}\n')
+        self.block = []
+
+    def close(self):
+        self.flush_block()
+        self.cdxj_fp.close()
+        self.idx_fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ZipNumIndex:
+    """
+    Look up captures in a ZipNum compressed CDXJ index.
+    """
+
+    def __init__(self, cdxj_path, idx_path):
+        self.cdxj_path = cdxj_path
+        self.keys = []
+        self.ranges = []
+        with open(idx_path) as fp:
+            for line in fp:
+                key, _, offset, length, _ = line.rstrip('\n').split('\t')
+                self.keys.append(key)
+                self.ranges.append((int(offset), int(length)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read_block(self, fp, i):
+        offset, length = self.ranges[i]
+        fp.seek(offset)
+        data = zlib.decompress(fp.read(length), 16 + zlib.MAX_WBITS)
+        return data.decode('utf-8').splitlines()
+
+    def lookup(self, url):
+        """
+        Return all of the captures for the URL, sorted oldest first.
+        """
+        key = surt(url)
+        prefix = key + ' '
+
+        # The first block that could contain the key is the one before the
+        # first block that starts with (or after) it.
+        i = max(bisect.bisect_left(self.keys, key) - 1, 0)
+
+        captures = []
+        with open(self.cdxj_path, 'rb') as fp:
+            while i < len(self.keys):
+                for line in self.read_block(fp, i):
+                    if line.startswith(prefix):
+                        captures.append(parse_line(line))
+                    elif line > prefix:
+                        return captures
+                i += 1
+        return captures
+
+    def lookup_latest(self, url):
+        captures = self.lookup(url)
+        return captures[-1] if captures else None
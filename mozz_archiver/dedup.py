@@ -0,0 +1,137 @@
+"""
+Payload digest index, used to write WARC revisit records for duplicate content.
+"""
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SQL_INITIALIZE_TABLES = """
+CREATE TABLE IF NOT EXISTS "digests" (
+    digest TEXT PRIMARY KEY,
+    uri TEXT,
+    date TEXT,
+    filename TEXT,
+    offset INTEGER,
+    length INTEGER,
+    payload_length INTEGER,
+    record_id TEXT
+);
+CREATE TABLE IF NOT EXISTS "seeds" (
+    path TEXT PRIMARY KEY,
+    loaded REAL,
+    digests INTEGER
+);
+"""
+
+# The earliest capture of each payload is taken to be the original record,
+# later rows in an index built by tools/index-archive may be revisits of it.
+SQL_SEED_DIGESTS = """
+INSERT OR IGNORE INTO "digests" (digest, uri, date, filename, offset, length, payload_length)
+SELECT payload_digest, url, warc_date, warc_filename, warc_offset, warc_length, content_length
+FROM seed.requests
+WHERE payload_digest IS NOT NULL
+    AND warc_filename IS NOT NULL
+    AND error_message IS NULL
+    AND content_length >= ?
+ORDER BY warc_date;
+"""
+
+CHUNK_SIZE = 64 * 1024
+
+
+def payload_digest(fp):
+    """
+    Hash a file in the same "sha1:<base32>" format that warcio uses.
+
+    The file is rewound to where it started afterwards.
+    """
+    start = fp.tell()
+    digester = hashlib.sha1()
+    while chunk := fp.read(CHUNK_SIZE):
+        digester.update(chunk)
+    fp.seek(start)
+    return 'sha1:' + base64.b32encode(digester.digest()).decode('ascii')
+
+
+class DigestIndex:
+    """
+    Map each payload digest to the WARC record where it was first archived.
+
+    The WARC writer threads all share the same connection, so every query
+    holds a lock. Without a database path the index only lives in memory
+    and covers the current crawl.
+    """
+
+    def __init__(self, database=None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            database or ':memory:', isolation_level=None, check_same_thread=False, uri=True
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.executescript(SQL_INITIALIZE_TABLES)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM "digests";').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def lookup(self, digest):
+        """
+        Return the original record for a payload digest, or None.
+        """
+        with self.lock:
+            c = self.conn.execute('SELECT * FROM "digests" WHERE digest=?;', (digest,))
+            row = c.fetchone()
+        return dict(row) if row else None
+
+    def add(self, digest, uri, date, filename, offset, length, payload_length, record_id):
+        """
+        Save the location of a record, unless the payload was already archived.
+        """
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO "digests" VALUES (?,?,?,?,?,?,?,?);',
+                (digest, uri, date, filename, offset, length, payload_length, record_id),
+            )
+
+    def seed(self, index_db, min_size=0):
+        """
+        Load the payload digests from an index that was built by tools/index-archive.
+
+        Each index is only loaded once, so this is skipped when a crawl is resumed.
+        """
+        path = os.path.abspath(index_db)
+        with self.lock:
+            c = self.conn.execute('SELECT digests FROM "seeds" WHERE path=?;', (path,))
+            if c.fetchone():
+                return 0
+
+            start = time.monotonic()
+            self.conn.execute('ATTACH DATABASE ? AS seed;', (f'file:{path}?mode=ro',))
+            try:
+                self.conn.execute('BEGIN IMMEDIATE TRANSACTION;')
+                c = self.conn.execute(SQL_SEED_DIGESTS, (min_size,))
+                count = c.rowcount
+                self.conn.execute(
+                    'INSERT INTO "seeds" VALUES (?,?,?);', (path, time.time(), count)
+                )
+                self.conn.execute('COMMIT;')
+            except Exception:
+                self.conn.execute('ROLLBACK;')
+                raise
+            finally:
+                self.conn.execute('DETACH DATABASE seed;')
+
+        logger.info(f"Loaded {count} payload digests from {path} in {time.monotonic() - start:.1f}s")
+        return count
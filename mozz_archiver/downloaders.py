@@ -1,22 +1,36 @@
 import logging
 import time
-from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from urllib.parse import urldefrag, urlparse
 
-from scrapy.core.downloader.tls import ScrapyClientTLSOptions
+from OpenSSL import SSL
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.endpoints import connectProtocol, HostnameEndpoint, wrapClientTLS
 from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.internet.interfaces import IHandshakeListener
 from twisted.internet.protocol import connectionDone
 from twisted.internet.ssl import CertificateOptions, TLSVersion
 from twisted.protocols.basic import LineReceiver
 from twisted.protocols.policies import TimeoutMixin
+from zope.interface.declarations import implementer
 
+from mozz_archiver.resolvers import TimedHostnameResolver
 from mozz_archiver.responses import GeminiResponse
+from mozz_archiver.tls import GeminiClientConnectionCreator, TLSSessionCache, session_reused
 
 logger = logging.getLogger(__name__)
 
+# Upper bounds (in seconds) of the buckets used for the latency histograms
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def latency_bucket(seconds):
+    for bound in LATENCY_BUCKETS:
+        if seconds < bound:
+            return f'<{bound * 1000:g}ms'
+    return f'>={LATENCY_BUCKETS[-1] * 1000:g}ms'
+
 
 class GeminiDownloadHandler:
     """
@@ -35,16 +49,30 @@ class GeminiDownloadHandler:
 
     def __init__(self, settings, crawler=None):
         self.crawler = crawler
+        self.stats = crawler.stats if crawler else None
 
         self.default_maxsize = settings.getint('DOWNLOAD_MAXSIZE')
         self.default_warnsize = settings.getint('DOWNLOAD_WARNSIZE')
+        self.default_spoolsize = settings.getint('DOWNLOAD_SPOOLSIZE', 1_000_000)
         self.fail_on_dataloss = settings.getbool('DOWNLOAD_FAIL_ON_DATALOSS')
 
         self.context_factory = CertificateOptions(
             verify=False,
             raiseMinimumTo=TLSVersion.TLSv1_2,
             fixBrokenPeers=True,
+            enableSessionTickets=True,
         )
+        # A single OpenSSL context is shared between all connections, which
+        # is also required for sessions to be resumed across connections.
+        self.context = self.context_factory.getContext()
+        # Most gemini servers close the connection without sending a TLS
+        # close_notify. OpenSSL 3 treats that as a fatal error and marks the
+        # session as not resumable, so tell it to treat the EOF as a normal
+        # shutdown instead. Gemini has no content-length to protect anyway.
+        self.context.set_options(getattr(SSL, 'OP_IGNORE_UNEXPECTED_EOF', 0))
+
+        session_cache_size = settings.getint('TLS_SESSION_CACHE_SIZE', 10_000)
+        self.session_cache = TLSSessionCache(session_cache_size) if session_cache_size else None
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -56,21 +84,33 @@ class GeminiDownloadHandler:
 
         maxsize = getattr(spider, 'download_maxsize', self.default_maxsize)
         warnsize = getattr(spider, 'download_warnsize', self.default_warnsize)
+        spoolsize = getattr(spider, 'download_spoolsize', self.default_spoolsize)
 
         parts = urlparse(request.url)
         remote_host = bindaddress or parts.hostname
         remote_port = parts.port or 1965
 
+        logger.debug(f"Creating download request for {request.url}")
+        protocol = GeminiClientProtocol(request, maxsize, warnsize, spoolsize, timeout)
+
         hostname = HostnameEndpoint(reactor, remote_host, remote_port)
+        # There's no public hook for timing the DNS lookup, so wrap the resolver
+        # that the endpoint is going to use. If a future version of twisted
+        # renames the attribute, the request goes ahead without DNS timing.
+        name_resolver = getattr(hostname, '_nameResolver', None)
+        if name_resolver is not None:
+            hostname._nameResolver = TimedHostnameResolver(name_resolver, protocol.dns_resolved)
+
         # The recommended helper method for this (optionsForClientTLS) does not
-        # allow setting up a client context that accepts unverified certificates.
-        # So we are forced to use the private ClientTLSOptions method instead.
-        options = ScrapyClientTLSOptions(remote_host, self.context_factory.getContext())
+        # allow setting up a client context that accepts unverified certificates,
+        # or resuming a TLS session, so I'm using a custom connection creator.
+        options = GeminiClientConnectionCreator(
+            remote_host, self.context, self.session_cache, (remote_host, remote_port)
+        )
         # noinspection PyTypeChecker
         endpoint = wrapClientTLS(options, hostname)
 
-        logger.debug(f"Creating download request for {request.url}")
-        protocol = GeminiClientProtocol(request, maxsize, warnsize, timeout)
+        protocol.finished.addBoth(self.on_finished, protocol, options)
 
         # If the connection fails (DNS lookup, etc.) propagate the error so
         # that scrapy knows the request has completed.
@@ -79,50 +119,139 @@ class GeminiDownloadHandler:
 
         return protocol.finished
 
+    def on_finished(self, result, protocol, options):
+        """
+        Save the TLS session and record the timing stats for the request.
 
+        This runs for both successful and failed requests, so a timeout will
+        still show which phase of the request it got stuck in.
+        """
+        latency = protocol.latency()
+        protocol.request.meta['gemini_latency'] = latency
+        if self.stats:
+            slot = protocol.request.meta.get('download_slot', urlparse(protocol.request_url).hostname)
+            self.record_latency(slot, latency)
+
+        if protocol.handshake_time is not None:
+            options.save_session()
+
+            if self.stats:
+                if protocol.tls_resumed is None:
+                    kind = 'unknown'
+                else:
+                    kind = 'resumed' if protocol.tls_resumed else 'full'
+                self.stats.inc_value(f'gemini/tls/{kind}_handshakes')
+                self.stats.inc_value(f'gemini/tls/{kind}_handshake_time', protocol.handshake_time)
+                if self.session_cache is not None:
+                    self.stats.set_value('gemini/tls/session_cache_size', len(self.session_cache))
+
+        return result
+
+    def record_latency(self, slot, latency):
+        """
+        Add the request's phase timings to the overall and per-slot histograms.
+
+        The per-slot histograms are kept in a single nested dictionary stat
+        value, {slot: {phase: {bucket: count}}}, to avoid creating thousands
+        of separate stat keys.
+        """
+        slots = self.stats.get_value('gemini/latency_by_slot')
+        if slots is None:
+            slots = {}
+            self.stats.set_value('gemini/latency_by_slot', slots)
+        phases = slots.setdefault(slot, {})
+
+        for phase in GeminiClientProtocol.latency_phases:
+            if phase in latency:
+                bucket = latency_bucket(latency[phase])
+                self.stats.inc_value(f'gemini/latency/{phase}/{bucket}')
+                histogram = phases.setdefault(phase, {})
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+
+
+@implementer(IHandshakeListener)
 class GeminiClientProtocol(LineReceiver, TimeoutMixin):
+    """
+    Client protocol for a single gemini request/response.
+
+    The raw response (header line + body) is written to a spooled temporary
+    file as it arrives. Responses up to spoolsize bytes stay in memory, and
+    anything larger is moved to a temporary file on disk, so the memory used
+    by a download is bounded by the spoolsize rather than by the maxsize.
+    The WARC exporter streams the record from this file, and only bodies
+    that are small or need to be parsed for links are loaded into memory as
+    the response body.
+    """
 
-    def __init__(self, request, maxsize, warnsize, timeout):
+    def __init__(self, request, maxsize, warnsize, spoolsize, timeout):
         self.request = request
         self.maxsize = maxsize
         self.warnsize = warnsize
+        self.spoolsize = spoolsize
         self.timout = timeout
 
         self.reached_warnsize = False
 
         self.request_url = urldefrag(self.request.url).url
         self.response_header = b''
-        self.response_body = BytesIO()
+        self.raw_response = SpooledTemporaryFile(max_size=spoolsize)
         self.response_size = 0
 
-        # Ideally this timer would start exactly when we send out the TCP SYN,
-        # but I don't know how to hook into that event with twisted.
+        # The DNS lookup starts right after this, and the TCP connect is timed
+        # from when the lookup finished. Twisted doesn't have a hook for when
+        # the TCP SYN actually goes out.
         self.start_time = time.time()
+        self.dns_start = None
+        self.dns_end = None
+        self.connect_time = None
+        self.handshake_time = None
+        self.tls_resumed = None
+        self.first_byte_time = None
+        self.end_time = None
 
         self.finished = Deferred(self.cancel)
 
     def cancel(self, _):
         self.transport.abortConnection()
 
+    def dns_resolved(self, start_time, end_time):
+        self.dns_start = start_time
+        self.dns_end = end_time
+
     def connectionMade(self):
+        # The TLS wrapper calls this as soon as the TCP connection is open,
+        # and buffers the request line until the handshake has finished.
+        self.connect_time = time.time()
         self.setTimeout(self.timout)
         self.sendLine(self.request_url.encode("utf-8"))
 
+    def handshakeCompleted(self):
+        self.handshake_time = time.time() - self.connect_time
+        self.tls_resumed = session_reused(self.transport.getHandle())
+        logger.debug(f"{self.request.url}: TLS handshake (resumed={self.tls_resumed})")
+
     def timeoutConnection(self):
         logger.error(
             f"Getting {self.request} took longer than {self.timout} seconds."
         )
+        self.request.meta['download_timed_out'] = True
         self.transport.abortConnection()
 
+    def dataReceived(self, data):
+        if self.first_byte_time is None:
+            self.first_byte_time = time.time()
+        super().dataReceived(data)
+
     def lineReceived(self, line):
         logger.debug(f"{self.request.url}: Line received")
         self.response_header = line
+        self.raw_response.write(line + self.delimiter)
         self.setRawMode()
 
     def rawDataReceived(self, data):
         if not self.response_size:
             logger.debug(f"{self.request.url}: Data received ({len(data)})")
-        self.response_body.write(data)
+        self.raw_response.write(data)
         self.response_size += len(data)
 
         if self.maxsize and self.response_size > self.maxsize:
@@ -130,9 +259,10 @@ class GeminiClientProtocol(LineReceiver, TimeoutMixin):
                 f"Received ({self.response_size}) bytes larger than download "
                 f"max size ({self.maxsize}) in request {self.request}."
             )
+            self.request.meta['download_maxsize_exceeded'] = True
 
-            # Clear buffer earlier to avoid keeping data in memory for a long time.
-            self.response_body.truncate(0)
+            # Clear buffer earlier to avoid keeping data around for a long time.
+            self.raw_response.truncate(0)
             self.finished.cancel()
 
         if self.warnsize and self.response_size > self.warnsize and not self.reached_warnsize:
@@ -144,6 +274,7 @@ class GeminiClientProtocol(LineReceiver, TimeoutMixin):
 
     def connectionLost(self, reason=connectionDone):
         logger.debug(f"{self.request.url}: Connection lost ({reason.value})")
+        self.end_time = time.time()
         self.setTimeout(None)
 
         if self.finished.called:
@@ -162,6 +293,64 @@ class GeminiClientProtocol(LineReceiver, TimeoutMixin):
         else:
             self.finished.errback(reason)
 
+    latency_phases = ('dns', 'connect', 'tls', 'first_byte', 'body', 'total')
+
+    def latency(self):
+        """
+        Break down the time spent on the request into phases (in seconds).
+
+            dns: Hostname lookup
+            connect: TCP connection, including any retries with other addresses
+            tls: TLS handshake
+            first_byte: From sending the request until the header arrives
+            body: From the first byte until the connection was closed
+            total: Everything, the same as download_latency
+
+        Phases that the request never reached are left out.
+        """
+        end_time = self.end_time or time.time()
+        latency = {'total': end_time - self.start_time}
+
+        if self.dns_end is not None:
+            latency['dns'] = self.dns_end - self.dns_start
+
+        if self.connect_time is not None:
+            latency['connect'] = self.connect_time - (self.dns_end or self.start_time)
+            request_time = self.connect_time
+            if self.handshake_time is not None:
+                latency['tls'] = self.handshake_time
+                request_time += self.handshake_time
+
+            if self.first_byte_time is not None:
+                latency['first_byte'] = self.first_byte_time - request_time
+                latency['body'] = end_time - self.first_byte_time
+                if latency['body'] > 0:
+                    received = len(self.response_header) + len(self.delimiter) + self.response_size
+                    latency['bytes_per_second'] = int(received / latency['body'])
+
+        return latency
+
+    def read_body(self):
+        """
+        Load the response body into memory if the spider might need it.
+
+        Gemtext documents are always loaded because they're parsed for links.
+        Other bodies are only loaded if they fit inside of the spool size, and
+        are otherwise left empty. The full response is still available from
+        the raw_file on the response object.
+        """
+        header_parts = self.response_header.split(maxsplit=1)
+        is_gemtext = (
+            len(header_parts) == 2
+            and header_parts[0].startswith(b'2')
+            and header_parts[1].startswith(b'text/gemini')
+        )
+        if self.response_size > self.spoolsize and not is_gemtext:
+            return b''
+
+        self.raw_response.seek(len(self.response_header) + len(self.delimiter))
+        return self.raw_response.read()
+
     def build_response(self):
         """
         Convert the response data into a pseudo-HTTP response.
@@ -169,7 +358,8 @@ class GeminiClientProtocol(LineReceiver, TimeoutMixin):
         return GeminiResponse(
             self.request_url,
             gemini_header=self.response_header,
-            body=self.response_body.getvalue(),
+            body=self.read_body(),
+            raw_file=self.raw_response,
             certificate=self.transport.getPeerCertificate(),
             ip_address=self.transport.getPeer().host,
         )
@@ -0,0 +1,286 @@
+import hashlib
+import logging
+import math
+import os
+import struct
+
+from scrapy.dupefilters import BaseDupeFilter
+
+from mozz_archiver.urls import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+
+SQL_INITIALIZE_TABLE = """
+CREATE TABLE IF NOT EXISTS "seen" (
+    fingerprint BLOB PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS "seen_format" (
+    format TEXT
+);
+"""
+
+# What the fingerprints in the "seen" table are a hash of. Job directories
+# from before the format was recorded hashed the URL as it was requested.
+FINGERPRINT_FORMAT = 'sha1-canonical-url'
+LEGACY_FINGERPRINT_FORMAT = 'sha1-url'
+
+
+class BloomFilter:
+    """
+    Fixed size bloom filter for SHA1 request fingerprints.
+
+    The fingerprints are already uniformly distributed hashes, so instead of
+    hashing them again the bit positions are derived from two slices of the
+    digest using double hashing.
+    """
+
+    HEADER = struct.Struct('<4sQIQ')
+    MAGIC = b'BLM1'
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate, max_bytes=None):
+        """
+        Size the filter for the expected number of items and false positive rate.
+
+        If max_bytes is smaller than the ideal size, the filter will be capped
+        at that size and the actual false positive rate will be higher.
+        """
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes:
+            num_bits = min(num_bits, max_bytes * 8)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, fingerprint):
+        h1 = int.from_bytes(fingerprint[:8], 'little')
+        h2 = int.from_bytes(fingerprint[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, fingerprint):
+        bits = self.bits
+        for pos in self._positions(fingerprint):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, fingerprint):
+        bits = self.bits
+        for pos in self._positions(fingerprint):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(self, path, watermark):
+        """
+        Write the filter to disk, along with the last table row that it covers.
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(self.HEADER.pack(self.MAGIC, self.num_bits, self.num_hashes, watermark))
+            fp.write(self.bits)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Load the bits from a saved filter and return its watermark.
+
+        Returns None if the file doesn't exist or was saved with different
+        parameters, in which case the filter is left untouched.
+        """
+        try:
+            with open(path, 'rb') as fp:
+                header = fp.read(self.HEADER.size)
+                magic, num_bits, num_hashes, watermark = self.HEADER.unpack(header)
+                if (magic, num_bits, num_hashes) != (self.MAGIC, self.num_bits, self.num_hashes):
+                    return None
+
+                bits = bytearray(fp.read())
+                if len(bits) != len(self.bits):
+                    return None
+        except (OSError, struct.error):
+            return None
+
+        self.bits = bits
+        return watermark
+
+
+class GeminiDupeFilter(BaseDupeFilter):
+    """
+    Dupefilter that keeps request fingerprints in the scheduler's database.
+
+    Fingerprints are stored as 20-byte SHA1 digests of the canonical URL in
+    the "seen" table. Writes go through the scheduler's CommitBatcher, so a
+    fingerprint is always committed in the same transaction as the request
+    that it belongs to. A bloom filter in front of the table answers the lookup for
+    most new URLs without touching the disk, and only possible duplicates
+    need a query to confirm them. This keeps memory usage fixed no matter
+    how many URLs have been seen.
+
+    The bloom filter is saved to the job directory when the crawl is closed.
+    On resume, it's topped up with any newer rows from the table instead of
+    being rebuilt from scratch.
+
+    Job directories that were started before fingerprints were taken from
+    the canonical URL can still be resumed, but a hash can't be converted
+    to the new format. The URLs that are still queued are fingerprinted
+    again, and the hash of the URL as it was requested is also checked. A
+    URL that was already crawled under a different form (e.g. an uppercase
+    host, or with the ":1965" port) may still be crawled a second time.
+    """
+
+    def __init__(self, batcher, bloom, bloom_path=None, legacy_path=None, debug=False):
+        self.batcher = batcher
+        self.conn = batcher.conn
+        self.bloom = bloom
+        self.bloom_path = bloom_path
+        self.legacy_path = legacy_path
+        self.debug = debug
+        self.logdupes = True
+        self.false_positives = 0
+        self.legacy_fingerprints = False
+
+        self.conn.executescript(SQL_INITIALIZE_TABLE)
+
+    @classmethod
+    def from_settings(cls, settings, batcher, jobdir_prefix=None):
+        bloom = BloomFilter.for_capacity(
+            settings.getint('DUPEFILTER_CAPACITY', 10_000_000),
+            settings.getfloat('DUPEFILTER_ERROR_RATE', 0.01),
+            settings.getint('DUPEFILTER_MAX_MEMORY', 0),
+        )
+        if jobdir_prefix:
+            bloom_path = f'{jobdir_prefix}.bloom'
+            legacy_path = os.path.join(os.path.dirname(jobdir_prefix), 'requests.seen')
+        else:
+            bloom_path, legacy_path = None, None
+
+        debug = settings.getbool('DUPEFILTER_DEBUG')
+        return cls(batcher, bloom, bloom_path, legacy_path, debug)
+
+    def open(self):
+        c = self.conn.execute('SELECT EXISTS (SELECT 1 FROM "seen");')
+        has_fingerprints = c.fetchone()[0]
+        if not has_fingerprints and self.legacy_path and os.path.exists(self.legacy_path):
+            self.import_legacy_file()
+            has_fingerprints = True
+
+        row = self.conn.execute('SELECT format FROM "seen_format";').fetchone()
+        if row is None:
+            if has_fingerprints:
+                self.migrate_legacy_fingerprints()
+                row = (LEGACY_FINGERPRINT_FORMAT,)
+            else:
+                self.set_format(FINGERPRINT_FORMAT)
+                row = (FINGERPRINT_FORMAT,)
+        self.legacy_fingerprints = row[0] != FINGERPRINT_FORMAT
+
+        watermark = 0
+        if self.bloom_path:
+            watermark = self.bloom.load(self.bloom_path) or 0
+
+        c = self.conn.execute('SELECT fingerprint FROM "seen" WHERE rowid > ?;', (watermark,))
+        for row in c:
+            self.bloom.add(row[0])
+
+        logger.info(
+            f"Loaded dupefilter bloom filter ({len(self.bloom.bits)} bytes, "
+            f"{self.bloom.num_hashes} hashes)"
+        )
+
+    def close(self, reason):
+        if self.bloom_path:
+            c = self.conn.execute('SELECT MAX(rowid) FROM "seen";')
+            watermark = c.fetchone()[0] or 0
+            self.bloom.save(self.bloom_path, watermark)
+
+    def set_format(self, fingerprint_format):
+        self.batcher.execute('DELETE FROM "seen_format";')
+        self.batcher.execute('INSERT INTO "seen_format" (format) VALUES (?);', (fingerprint_format,))
+        self.batcher.commit()
+
+    def migrate_legacy_fingerprints(self):
+        """
+        Add the canonical fingerprints for the requests in the scheduler queue
+        of a job directory that was started with the legacy format.
+        """
+        logger.warning(
+            "Dupefilter fingerprints were created from non-canonical URLs, "
+            "some URLs that were already crawled may be crawled again"
+        )
+        c = self.conn.execute('SELECT url FROM "scheduler";')
+        for (url,) in c.fetchall():
+            fingerprint = hashlib.sha1(canonicalize_url(url).encode('utf-8')).digest()
+            self.batcher.execute(
+                'INSERT OR IGNORE INTO "seen" (fingerprint) VALUES (?);', (fingerprint,)
+            )
+        self.set_format(LEGACY_FINGERPRINT_FORMAT)
+
+    def import_legacy_file(self):
+        """
+        Load the hex fingerprints from the requests.seen file of an older crawl.
+        """
+        logger.info(f"Importing dupefilter fingerprints from {self.legacy_path}")
+        with open(self.legacy_path) as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    self.batcher.execute(
+                        'INSERT OR IGNORE INTO "seen" (fingerprint) VALUES (?);',
+                        (bytes.fromhex(line),)
+                    )
+        self.batcher.commit()
+
+    def insert_fingerprints(self, fingerprints):
+        """
+        Add fingerprints in bulk, inside of a transaction that the caller manages.
+        """
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO "seen" (fingerprint) VALUES (?);',
+            [(fingerprint,) for fingerprint in fingerprints],
+        )
+        for fingerprint in fingerprints:
+            self.bloom.add(fingerprint)
+
+    def request_fingerprint(self, request):
+        url = canonicalize_url(request.url)
+        return hashlib.sha1(url.encode('utf-8')).digest()
+
+    def fingerprint_exists(self, fingerprint):
+        if fingerprint in self.bloom:
+            c = self.conn.execute('SELECT 1 FROM "seen" WHERE fingerprint=?;', (fingerprint,))
+            if c.fetchone():
+                return True
+            self.false_positives += 1
+        return False
+
+    def request_seen(self, request):
+        fingerprint = self.request_fingerprint(request)
+        if self.fingerprint_exists(fingerprint):
+            return True
+
+        if self.legacy_fingerprints and canonicalize_url(request.url) != request.url:
+            if self.fingerprint_exists(hashlib.sha1(request.url.encode('utf-8')).digest()):
+                return True
+
+        self.bloom.add(fingerprint)
+        self.batcher.execute(
+            'INSERT OR IGNORE INTO "seen" (fingerprint) VALUES (?);', (fingerprint,)
+        )
+        return False
+
+    def log(self, request, spider):
+        if self.debug:
+            msg = "Filtered duplicate request: %(request)s"
+            logger.debug(msg, {'request': request}, extra={'spider': spider})
+        elif self.logdupes:
+            msg = ("Filtered duplicate request: %(request)s"
+                   " - no more duplicates will be shown"
+                   " (see DUPEFILTER_DEBUG to show all duplicates)")
+            logger.debug(msg, {'request': request}, extra={'spider': spider})
+            self.logdupes = False
+
+        spider.crawler.stats.inc_value('dupefilter/filtered', spider=spider)
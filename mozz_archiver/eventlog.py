@@ -0,0 +1,179 @@
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+
+from . import signals as mozz_signals
+from .extensions import WriterThread
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlEventLog:
+    """
+    Downloader middleware that writes one structured record for the outcome
+    of every request to a rotating, gzip compressed JSON lines file.
+
+    Responses are logged once their WARC records have been written, so the
+    event includes the WARC filename and the byte range of the response
+    record. Requests that fail (or that are rejected by another middleware,
+    like robots.txt) are logged with an error message in the same format that
+    tools/index-archive uses when it scrapes the text log. This includes
+    requests that were rejected by the scheduler before they were queued. An example event:
+
+        {"time":1604707200.0,"url":"gemini://mozz.us/","slot":"mozz.us",
+         "status":"20","meta":"text/gemini","bytes":4303,"latency":{...},
+         "digest":"sha1:...","warc_date":"2020-11-07T00:00:00.000000Z",
+         "warc_filename":"...warc.gz","warc_offset":1066,"warc_length":2013}
+
+    Duplicate payloads that were archived as revisit records also have a
+    "revisit_of" field with the url and warc_date of the original capture.
+
+    Events are serialized, compressed and written on a background thread.
+
+    This runs at a lower priority than the retry middleware, so a request
+    is only logged once the retries have been exhausted.
+    """
+
+    # Rejections from other middlewares, mapped to the index error messages
+    ignore_messages = {
+        'Forbidden by robots.txt': 'URL forbidden by robots.txt',
+        'Forbidden by URL deny list': 'URL forbidden by block list',
+        'Forbidden by trap detector': 'URL forbidden by trap detector',
+    }
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('EVENT_LOG_ENABLED'):
+            raise NotConfigured
+
+        self.stats = crawler.stats
+        self.directory = settings.get('EVENT_LOG_DIRECTORY', '.')
+        self.prefix = settings.get('WARC_FILE_PREFIX')
+        self.max_file_size = settings.getint('EVENT_LOG_MAX_SIZE')
+        self.default_maxsize = settings.getint('DOWNLOAD_MAXSIZE')
+
+        queue_size = settings.getint('EVENT_LOG_QUEUE_SIZE', 10_000)
+        self.thread = WriterThread(self.write_event, queue_size, name='EventLogThread')
+
+        # These are only touched by the writer thread until it has been stopped
+        self.serial = 0
+        self.fp = None
+        self.gzip_fp = None
+        self.events_written = 0
+
+        crawler.signals.connect(self.engine_started, signal=signals.engine_started)
+        crawler.signals.connect(self.engine_stopped, signal=signals.engine_stopped)
+        crawler.signals.connect(self.warc_record_written, signal=mozz_signals.warc_record_written)
+        crawler.signals.connect(self.process_exception, signal=mozz_signals.request_rejected)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def engine_started(self):
+        self.thread.start()
+
+    def engine_stopped(self):
+        # The WARC exporter is an extension, so it was connected to this
+        # signal first and has already finished writing its records.
+        logger.info(f"Waiting for {self.thread.qsize()} crawl events to finish writing")
+        self.thread.stop()
+        self.close_file()
+        self.stats.set_value('eventlog/events_written', self.events_written)
+        self.stats.set_value('eventlog/files', self.serial)
+
+    def build_event(self, request):
+        event = {
+            'time': round(time.time(), 3),
+            'url': request.url,
+            'slot': request.meta.get('download_slot') or urlparse_cached(request).hostname,
+        }
+        latency = request.meta.get('gemini_latency')
+        if latency:
+            event['latency'] = {phase: round(value, 4) for phase, value in latency.items()}
+        return event
+
+    def get_error_message(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            message = str(exception)
+            return self.ignore_messages.get(message, f"Error: {message}")
+        elif request.meta.get('download_timed_out'):
+            timeout = request.meta.get('download_timeout', 0)
+            return f"Download timed out after {timeout:g} seconds"
+        elif request.meta.get('download_maxsize_exceeded'):
+            maxsize = getattr(spider, 'download_maxsize', self.default_maxsize)
+            return f"Download exceeded max size of {maxsize / 1_000_000:g} MB"
+        else:
+            return f"Error: {exception}"
+
+    def process_exception(self, request, exception, spider):
+        event = self.build_event(request)
+        event['error'] = self.get_error_message(request, exception, spider)
+        cls = type(exception)
+        event['error_class'] = f'{cls.__module__}.{cls.__qualname__}'
+        self.thread.put(event)
+
+    def warc_record_written(self, request, response, record, filename, offset, length,
+                            revisit_of=None):
+        """
+        Log a successful response once its WARC record has been written.
+
+        For a revisit record, the event points at the original record instead
+        since that's where the response can be read back from, and the file
+        that the revisit itself was written to is saved as record_filename.
+        """
+        event = self.build_event(request)
+        event['status'] = getattr(response, 'gemini_status', None)
+        event['meta'] = getattr(response, 'gemini_meta', None)
+        event['bytes'] = int(record.rec_headers.get_header('Content-Length'))
+        event['digest'] = record.rec_headers.get_header('WARC-Payload-Digest')
+        event['warc_date'] = record.rec_headers.get_header('WARC-Date')
+        event['warc_filename'] = filename
+        event['warc_offset'] = offset
+        event['warc_length'] = length
+        if revisit_of is not None:
+            event['record_filename'] = filename
+            event['bytes'] = revisit_of['payload_length']
+            event['warc_filename'] = revisit_of['filename']
+            event['warc_offset'] = revisit_of['offset']
+            event['warc_length'] = revisit_of['length']
+            event['revisit_of'] = {'url': revisit_of['uri'], 'warc_date': revisit_of['date']}
+        self.thread.put(event)
+
+    def build_filename(self):
+        timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        return f'{self.prefix}-{timestamp}-{str(self.serial).zfill(6)}-events.jsonl.gz'
+
+    def open_file(self):
+        filename = self.build_filename()
+        logger.debug(f"Generating crawl event log {filename}")
+        self.fp = open(os.path.join(self.directory, filename), 'wb')
+        self.gzip_fp = gzip.GzipFile(fileobj=self.fp, mode='wb', compresslevel=6)
+        self.serial += 1
+
+    def close_file(self):
+        if self.gzip_fp is not None:
+            self.gzip_fp.close()
+            self.fp.close()
+            self.gzip_fp = self.fp = None
+
+    def write_event(self, event):
+        """
+        This runs on the writer thread.
+        """
+        if self.gzip_fp is None:
+            self.open_file()
+
+        self.gzip_fp.write(json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n')
+        self.events_written += 1
+
+        # The size of the compressed file, minus whatever zlib is still holding onto
+        if self.max_file_size and self.fp.tell() > self.max_file_size:
+            self.close_file()
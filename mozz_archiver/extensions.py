@@ -1,61 +1,308 @@
 import io
+import itertools
 import logging
 import os
+import queue
 import socket
 import sys
+import threading
+import time
+import zlib
 from datetime import datetime
 
 from scrapy import signals
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.job import job_dir
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from warcio.timeutils import datetime_to_iso_date
 from warcio.warcwriter import WARCWriter
 
+from . import signals as mozz_signals
+from .dedup import DigestIndex, payload_digest
+
 logger = logging.getLogger(__name__)
 
 
+class TimedFile:
+    """
+    File wrapper that keeps track of the time and bytes spent writing to disk.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.write_time = 0.0
+        self.bytes_written = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        count = self.fp.write(data)
+        self.write_time += time.perf_counter() - start
+        self.bytes_written += len(data)
+        return count
+
+    def flush(self):
+        start = time.perf_counter()
+        self.fp.flush()
+        self.write_time += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class WriterThread(threading.Thread):
+    """
+    Background thread that pulls jobs from a bounded queue and hands them off
+    to a handler function, one at a time and in order.
+
+    Putting a job on a full queue will block the caller until the thread has
+    caught up. Producers that can't afford to block should check full() first.
+    """
+
+    def __init__(self, handler, maxsize=0, name=None):
+        super().__init__(name=name, daemon=True)
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, job):
+        self.queue.put(job)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def full(self):
+        return self.queue.full()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                self.handler(job)
+            except Exception:
+                logger.exception(f"Error in {self.name} while processing job")
+
+    def stop(self):
+        """
+        Wait for the remaining jobs to finish and shut down the thread.
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+
+class WARCShard:
+    """
+    A single rotating WARC file, along with the thread that writes to it.
+
+    Each shard keeps its own serial number. Serials are interleaved between
+    shards (shard 1 of 4 will use 1, 5, 9, ...) so that every filename in the
+    crawl stays unique.
+    """
+
+    def __init__(self, exporter, index, num_shards, directory, queue_size):
+        self.exporter = exporter
+        self.index = index
+        self.num_shards = num_shards
+        self.directory = directory
+        self.rotations = 0
+        self.filename = None
+        self._writer = None
+        self.thread = WriterThread(self.write_job, queue_size, name=f'WARCWriterThread-{index}')
+
+        # These are only updated by the writer thread, and are copied into
+        # the crawler stats periodically from the reactor thread.
+        self.responses_written = 0
+        self.revisits_written = 0
+        self.bytes_saved = 0
+        self.bytes_written = 0
+        self.compress_time = 0.0
+        self.disk_time = 0.0
+
+    @property
+    def serial(self):
+        return self.index + self.rotations * self.num_shards
+
+    @property
+    def writer(self):
+        """
+        Rotating file writer that will increment once the max size has been reached.
+        """
+        if not self._writer:
+            self.open_writer()
+
+        max_file_size = self.exporter.max_file_size
+        if not self.exporter.debug and max_file_size and self._writer.out.tell() > max_file_size:
+            self.rotations += 1
+            self.close_writer()
+            self.open_writer()
+
+        return self._writer
+
+    def open_writer(self):
+        self.filename = self.exporter.build_filename(self.serial)
+        self._writer = self.exporter.build_writer(self.directory, self.filename)
+
+    def close_writer(self):
+        """
+        Flush the current WARC file and close it (stdout is only flushed).
+        """
+        out = self._writer.out
+        out.flush()
+        if out.fp is not sys.stdout.buffer:
+            out.close()
+        self._writer = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.thread.stop()
+        if self._writer:
+            self.close_writer()
+
+    def write_job(self, job):
+        """
+        Compress and write the records for a single response.
+
+        This runs on the writer thread.
+        """
+        try:
+            writer = self.writer
+            out = writer.out
+            start_time = time.perf_counter()
+            start_disk_time = out.write_time
+            start_bytes = out.bytes_written
+
+            record, offset, length = self.exporter.write_records(writer, job)
+
+            # Everything that isn't spent waiting on the disk is gzip
+            # compression and digest calculation.
+            elapsed = time.perf_counter() - start_time
+            disk_time = out.write_time - start_disk_time
+            self.compress_time += elapsed - disk_time
+            self.disk_time += disk_time
+            self.bytes_written += out.bytes_written - start_bytes
+            self.responses_written += 1
+            if job.get('revisit_of'):
+                self.revisits_written += 1
+                self.bytes_saved += job['response_length']
+
+            self.exporter.record_written(job, record, self.filename, offset, length)
+        finally:
+            job['response_payload'].close()
+
+
 class WARCExporter:
     """
     Archive responses using the WARC file format.
 
+    Records are compressed and written to disk on background threads, so
+    a large response never stalls the twisted reactor. When a write queue
+    starts to back up, the scheduler will stop handing out new requests via
+    the is_saturated() hook until the thread has caught up.
+
+    Output can be split between several WARC files that are written in
+    parallel (WARC_SHARDS). Responses are assigned to a shard either by their
+    netloc, which keeps every capture from a site together in the same set
+    of files, or in round robin order. Shards are spread across each of the
+    directories in WARC_FILE_DIRECTORY.
+
+    With WARC_DEDUP_ENABLED, the payload digest of every response is looked
+    up in an index of everything that has already been archived (kept in the
+    JOBDIR, and optionally seeded from a previous crawl's index database).
+    Duplicate payloads are written as "revisit" records that refer back to
+    the original capture, instead of storing the same content again.
+
     References:
         https://iipc.github.io/warc-specifications/specifications/warc-format/warc-1.1/
     """
 
-    def __init__(self, settings):
+    stats_interval = 5
+
+    # Request phase timings that are added to the metadata record
+    latency_metadata_keys = {
+        'dns': 'dnsTimeMs',
+        'connect': 'connectTimeMs',
+        'tls': 'tlsTimeMs',
+        'first_byte': 'firstByteTimeMs',
+        'body': 'bodyTimeMs',
+    }
+
+    def __init__(self, settings, stats, signals=None):
         self.settings = settings
+        self.stats = stats
+        self.signals = signals
         self.hostname = socket.gethostname()
         self.ip_address = socket.gethostbyname(self.hostname)
         self.debug = self.settings.getbool('WARC_DEBUG', 'False')
-        self.serial = 0
-        self._writer = None
+        self.use_micros = self.settings['WARC_VERSION'] >= 'WARC/1.1'
+        self.max_file_size = self.settings.getint('WARC_FILE_MAX_SIZE')
+
+        self.shard_by = self.settings.get('WARC_SHARD_BY', 'netloc')
+        if self.shard_by not in ('netloc', 'round-robin'):
+            raise ValueError(f"Invalid WARC_SHARD_BY setting: {self.shard_by}")
+
+        # Interleaving records from several shards on stdout would produce garbage
+        num_shards = 1 if self.debug else max(self.settings.getint('WARC_SHARDS', 1), 1)
+        directories = self.settings.getlist('WARC_FILE_DIRECTORY') or ['.']
+        queue_size = self.settings.getint('WARC_WRITER_QUEUE_SIZE', 100)
+        self.high_water = max(queue_size // 2, 1)
+        self.shards = [
+            WARCShard(self, i, num_shards, directories[i % len(directories)], queue_size)
+            for i in range(num_shards)
+        ]
+        self.round_robin = itertools.cycle(self.shards)
+
+        self.stats_loop = LoopingCall(self.update_stats)
+        self.stats_time = time.monotonic()
+        self.stats_bytes = 0
+
+        # Signals for written records are handed from the writer threads to
+        # the reactor thread, since signal handlers aren't thread-safe
+        self.written = queue.SimpleQueue()
+
+        # Writing to stdout, there's no offset to point the revisit records at
+        self.dedup = None
+        self.dedup_min_size = self.settings.getint('WARC_DEDUP_MIN_SIZE', 1024)
+        if self.settings.getbool('WARC_DEDUP_ENABLED') and not self.debug:
+            jobdir = job_dir(self.settings)
+            self.dedup = DigestIndex(os.path.join(jobdir, 'dedup.sqlite3') if jobdir else None)
+            seed_index = self.settings.get('WARC_DEDUP_SEED_INDEX')
+            if seed_index:
+                self.dedup.seed(seed_index, self.dedup_min_size)
 
     @classmethod
     def from_crawler(cls, crawler):
-        ext = cls(crawler.settings)
+        ext = cls(crawler.settings, crawler.stats, crawler.signals)
+        crawler.signals.connect(ext.engine_started, signal=signals.engine_started)
+        crawler.signals.connect(ext.engine_stopped, signal=signals.engine_stopped)
         crawler.signals.connect(ext.response_received, signal=signals.response_received)
         return ext
 
-    @property
-    def writer(self):
+    def is_saturated(self):
         """
-        Rotating file writer that will increment once the max size has been reached.
-        """
-        if not self._writer:
-            self._writer = self.build_writer()
+        Scheduler hook to pause new downloads while a write queue drains.
 
-        max_file_size = self.settings.getint('WARC_FILE_MAX_SIZE')
-        if not self.debug and max_file_size and self._writer.out.tell() > max_file_size:
-            self.serial += 1
-            self._writer.out.close()
-            self._writer = self.build_writer()
+        This checks each shard separately because a single full shard is
+        enough to block the reactor.
+        """
+        return any(shard.thread.qsize() >= self.high_water for shard in self.shards)
 
-        return self._writer
+    def get_shard(self, response):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        elif self.shard_by == 'netloc':
+            netloc = urlparse_cached(response).netloc
+            return self.shards[zlib.crc32(netloc.encode()) % len(self.shards)]
+        else:
+            return next(self.round_robin)
 
-    def build_writer(self):
+    def build_writer(self, directory, filename):
         """
         Initialize a new WARC file and write the "warcinfo" header.
         """
-        directory = self.settings.get('WARC_FILE_DIRECTORY', '.')
-        filename = self.build_filename()
-
         if self.debug:
             fp = sys.stdout.buffer
         else:
@@ -63,7 +310,7 @@ class WARCExporter:
 
         logger.debug(f"Generating WARC file {filename}")
         writer = WARCWriter(
-            fp,
+            TimedFile(fp),
             gzip=self.settings.getbool('WARC_GZIP', True),
             warc_version=self.settings['WARC_VERSION'],
         )
@@ -84,14 +331,14 @@ class WARCExporter:
         writer.write_record(warcinfo_record)
         return writer
 
-    def build_filename(self):
+    def build_filename(self, serial):
         """
         Build a filename using the naming convention recommended in the spec.
         """
         filename = '{prefix}-{timestamp}-{serial}-{crawlhost}.warc'.format(
             prefix=self.settings['WARC_FILE_PREFIX'],
             timestamp=datetime.utcnow().strftime('%Y%m%d%H%M%S'),
-            serial=str(self.serial).zfill(6),
+            serial=str(serial).zfill(6),
             crawlhost=self.ip_address
         )
         if self.settings['WARC_GZIP']:
@@ -99,10 +346,62 @@ class WARCExporter:
 
         return filename
 
+    def engine_started(self):
+        self.stats_time = time.monotonic()
+        for shard in self.shards:
+            shard.start()
+        self.stats_loop.start(self.stats_interval, now=False)
+
     def engine_stopped(self):
-        if self._writer:
-            self._writer.out.close()
-            self._writer = None
+        if self.stats_loop.running:
+            self.stats_loop.stop()
+
+        queue_depth = sum(shard.thread.qsize() for shard in self.shards)
+        logger.info(f"Waiting for {queue_depth} WARC records to finish writing")
+        for shard in self.shards:
+            shard.stop()
+        self.update_stats()
+        # The reactor won't get to the last batch before the other
+        # engine_stopped handlers (e.g. the event log) have run
+        self.send_written()
+
+        if self.dedup is not None:
+            self.dedup.close()
+            revisits = self.stats.get_value('warc/revisits_written')
+            bytes_saved = self.stats.get_value('warc/dedup_bytes_saved')
+            logger.info(
+                f"Wrote {revisits} revisit records for duplicate payloads, "
+                f"saving {bytes_saved / 1_000_000:.1f} MB"
+            )
+
+    def update_stats(self):
+        """
+        Copy the writer threads' counters into the crawler stats.
+        """
+        bytes_written = sum(shard.bytes_written for shard in self.shards)
+        now = time.monotonic()
+        elapsed = now - self.stats_time
+        if elapsed > 0:
+            rate = (bytes_written - self.stats_bytes) / elapsed
+            self.stats.set_value('warc/bytes_per_second', int(rate))
+        self.stats_time = now
+        self.stats_bytes = bytes_written
+
+        queue_depth = sum(shard.thread.qsize() for shard in self.shards)
+        responses_written = sum(shard.responses_written for shard in self.shards)
+        compress_time = sum(shard.compress_time for shard in self.shards)
+        disk_time = sum(shard.disk_time for shard in self.shards)
+        self.stats.set_value('warc/queue_depth', queue_depth)
+        self.stats.max_value('warc/queue_max_depth', queue_depth)
+        self.stats.set_value('warc/responses_written', responses_written)
+        if self.dedup is not None:
+            revisits_written = sum(shard.revisits_written for shard in self.shards)
+            bytes_saved = sum(shard.bytes_saved for shard in self.shards)
+            self.stats.set_value('warc/revisits_written', revisits_written)
+            self.stats.set_value('warc/dedup_bytes_saved', bytes_saved)
+        self.stats.set_value('warc/bytes_written', bytes_written)
+        self.stats.set_value('warc/compress_time', round(compress_time, 3))
+        self.stats.set_value('warc/disk_time', round(disk_time, 3))
 
     def build_warc_metadata_payload(self, metadata):
         payload = io.BytesIO()
@@ -111,43 +410,135 @@ class WARCExporter:
         payload.seek(0)
         return payload
 
-    def response_received(self, response, request, spider):
-        request_payload = io.BytesIO()
-        request_payload.write(response.url.encode('utf-8') + b'\r\n')
-        request_payload.seek(0)
+    def build_response_payload(self, response):
+        """
+        Return a file object with the raw response and the length of the file.
+
+        The raw file is read in chunks when the record is written, so large
+        responses never need to be loaded into memory.
+        """
+        if response.raw_file is not None:
+            response_payload = response.raw_file
+        else:
+            response_payload = io.BytesIO()
+            response_payload.write(response.gemini_header + b'\r\n')
+            response_payload.write(response.body)
 
-        response_payload = io.BytesIO()
-        response_payload.write(response.gemini_header + b'\r\n')
-        response_payload.write(response.body)
+        response_payload.seek(0, os.SEEK_END)
+        length = response_payload.tell()
         response_payload.seek(0)
+        return response_payload, length
 
-        response_record = self.writer.create_warc_record(
-            response.url,
-            'response',
-            payload=response_payload,
-            warc_content_type='application/gemini; msgtype=response',
-            warc_headers_dict={'WARC-IP-Address': response.ip_address},
-        )
-        request_record = self.writer.create_warc_record(
-            response.url,
-            'request',
-            payload=request_payload,
-            warc_content_type='application/gemini; msgtype=request',
-            warc_headers_dict={'WARC-IP-Address': response.ip_address},
-        )
-        self.writer.write_request_response_pair(request_record, response_record)
+    def response_received(self, response, request, spider):
+        """
+        Snapshot everything that the records need and queue them for writing.
+
+        This runs on the reactor thread, so it should never touch the disk.
+        """
+        response_payload, response_length = self.build_response_payload(response)
 
+        metadata = None
         if self.settings.getbool('WARC_WRITE_METADATA', 'False'):
             metadata = {
                 'fetchTimeMs': int(response.meta["download_latency"] * 1000),
             }
+            latency = response.meta.get('gemini_latency', {})
+            for phase, key in self.latency_metadata_keys.items():
+                if phase in latency:
+                    metadata[key] = int(latency[phase] * 1000)
             referrer = request.headers.get('Referer')
             if referrer is not None:
                 metadata['via'] = referrer.decode()
 
-            metadata_payload = self.build_warc_metadata_payload(metadata)
-            metadata_record = self.writer.create_warc_record(
-                response.url,
+        job = {
+            'request': request,
+            'response': response,
+            'url': response.url,
+            'ip_address': response.ip_address,
+            'warc_date': datetime_to_iso_date(datetime.utcnow(), use_micros=self.use_micros),
+            'response_payload': response_payload,
+            'response_length': response_length,
+            'metadata': metadata,
+        }
+        shard = self.get_shard(response)
+        if shard.thread.full():
+            logger.debug("WARC write queue is full, blocking until it drains")
+            self.stats.inc_value('warc/queue_blocked')
+        shard.thread.put(job)
+
+    def write_records(self, writer, job):
+        """
+        Write the records for a response, and return the response (or revisit)
+        record along with its offset and length in the WARC file.
+        """
+        url = job['url']
+        warc_headers_dict = {
+            'WARC-IP-Address': job['ip_address'],
+            'WARC-Date': job['warc_date'],
+        }
+
+        revisit_of = None
+        response_headers = dict(warc_headers_dict)
+        if self.dedup is not None and job['response_length'] >= self.dedup_min_size:
+            digest = job['payload_digest'] = payload_digest(job['response_payload'])
+            revisit_of = job['revisit_of'] = self.dedup.lookup(digest)
+            if revisit_of is None:
+                # Gemini responses have no HTTP headers, so the block is the
+                # payload. Passing the digests along saves warcio from
+                # hashing the response a second time.
+                response_headers['WARC-Payload-Digest'] = digest
+                response_headers['WARC-Block-Digest'] = digest
+            elif revisit_of['record_id']:
+                response_headers['WARC-Refers-To'] = revisit_of['record_id']
+
+        request_payload = io.BytesIO()
+        request_payload.write(url.encode('utf-8') + b'\r\n')
+        request_payload.seek(0)
+
+        if revisit_of is not None:
+            # The block is left empty, the gemini header line is part of the
+            # payload so it's identical to the original capture's.
+            response_headers['Content-Type'] = 'application/gemini; msgtype=response'
+            response_record = writer.create_revisit_record(
+                url,
+                digest,
+                revisit_of['uri'],
+                revisit_of['date'],
+                warc_headers_dict=response_headers,
+            )
+        else:
+            response_record = writer.create_warc_record(
+                url,
+                'response',
+                payload=job['response_payload'],
+                length=job['response_length'],
+                warc_content_type='application/gemini; msgtype=response',
+                warc_headers_dict=response_headers,
+            )
+        request_record = writer.create_warc_record(
+            url,
+            'request',
+            payload=request_payload,
+            warc_content_type='application/gemini; msgtype=request',
+            warc_headers_dict=warc_headers_dict,
+        )
+        # Same as writer.write_request_response_pair(), but keeping track of
+        # where the response record ends up in the file (stdout can't seek).
+        request_record.rec_headers.add_header(
+            'WARC-Concurrent-To', response_record.rec_headers.get_header('WARC-Record-ID')
+        )
+        offset = length = None
+        if not self.debug:
+            offset = writer.out.tell()
+        writer.write_record(response_record)
+        if not self.debug:
+            length = writer.out.tell() - offset
+        writer.write_record(request_record)
+
+        if job['metadata'] is not None:
+            metadata_payload = self.build_warc_metadata_payload(job['metadata'])
+            metadata_record = writer.create_warc_record(
+                url,
                 'metadata',
                 payload=metadata_payload,
                 warc_headers_dict={
@@ -155,4 +546,46 @@ class WARCExporter:
                     'WARC-Concurrent-To': response_record.rec_headers.get_header('WARC-Record-ID')
                 },
             )
-            self.writer.write_record(metadata_record)
+            writer.write_record(metadata_record)
+
+        return response_record, offset, length
+
+    def record_written(self, job, record, filename, offset, length):
+        """
+        Notify any listeners that a response has been written to the archive.
+
+        This is called from the writer thread, the signal itself is sent from
+        the reactor thread by send_written().
+        """
+        revisit_of = job.get('revisit_of')
+        if revisit_of is None and 'payload_digest' in job:
+            self.dedup.add(
+                job['payload_digest'], job['url'], job['warc_date'], filename, offset, length,
+                job['response_length'], record.rec_headers.get_header('WARC-Record-ID'),
+            )
+
+        if self.signals is None:
+            return
+
+        self.written.put({
+            'request': job['request'],
+            'response': job['response'],
+            'record': record,
+            'filename': filename,
+            'offset': offset,
+            'length': length,
+            'revisit_of': revisit_of,
+        })
+        reactor.callFromThread(self.send_written)
+
+    def send_written(self):
+        """
+        Send the warc_record_written signal for every record that has been
+        written since the last call.
+        """
+        while True:
+            try:
+                kwargs = self.written.get_nowait()
+            except queue.Empty:
+                return
+            self.signals.send_catch_log(mozz_signals.warc_record_written, **kwargs)
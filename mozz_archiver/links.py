@@ -0,0 +1,162 @@
+"""
+Link extraction for text/gemini documents.
+
+Link lines are found with a regex over the raw response body instead of
+decoding the whole document and splitting it into lines, and relative links
+are resolved against a base URL that's only parsed once per page.
+"""
+import codecs
+import functools
+import pathlib
+import posixpath
+import re
+from urllib.parse import urlparse, urlsplit, urlunparse
+
+from .urls import PATH_SAFE, canonicalize_url, normalize_percent_encoding, remove_dot_segments
+
+# Link lines are found by searching for the literal "\n=>", which is much
+# faster than anchoring the regex to the start of each line with re.M.
+RE_LINK = re.compile(rb'\n=>([^\r\n]*)')
+RE_FIRST_LINK = re.compile(rb'=>([^\r\n]*)')
+
+# Links that can't be anything other than a relative path
+RE_PATH_ONLY = re.compile(r'[^:?#;]+')
+
+# Absolute gemini:// links without a query, fragment or params
+RE_GEMINI_URL = re.compile(r'gemini://([^/?#;\[\]]+)([^?#;]*)')
+
+# Encodings where the bytes for "=>", "\r" and "\n" can't show up inside of
+# any other character, so the body can be scanned without decoding it.
+ASCII_COMPATIBLE_CODECS = frozenset([
+    'ascii', 'utf-8', 'latin-1', 'koi8-r', 'koi8-u', 'mac-roman',
+])
+
+
+@functools.lru_cache(maxsize=64)
+def is_ascii_compatible(charset):
+    try:
+        name = codecs.lookup(charset).name
+    except (LookupError, TypeError):
+        return False
+    return name in ASCII_COMPATIBLE_CODECS or name.startswith(('iso8859-', 'cp125'))
+
+
+def iter_links(body, charset='utf-8'):
+    """
+    Generate the link URLs from the encoded body of a gemtext document.
+    """
+    if b'\r=>' in body:
+        # Lines that end with a lone carriage return
+        body = body.replace(b'\r', b'\n')
+
+    lines = RE_LINK.findall(body)
+    first = RE_FIRST_LINK.match(body)
+    if first:
+        lines.insert(0, first.group(1))
+
+    for line in lines:
+        link_parts = line.decode(charset, errors='replace').split(maxsplit=1)
+        if link_parts:
+            yield link_parts[0]
+
+
+def iter_text_links(text):
+    """
+    Generate the link URLs from a decoded gemtext document.
+    """
+    for line in text.splitlines(keepends=False):
+        if line.startswith('=>'):
+            link_parts = line[2:].strip().split(maxsplit=1)
+            if link_parts:
+                yield link_parts[0]
+
+
+def normalize_path(path):
+    # os.path.normpath() only needs to be called if there's something to remove
+    if '/.' in path or '//' in path or path.startswith('.') or path.endswith('/'):
+        return posixpath.normpath(path)
+    return path
+
+
+class LinkResolver:
+    """
+    Convert potentially relative gemini links into full URLs.
+
+    The base Response class has a method for this, but it doesn't seem to
+    work properly for all of the edge cases that I tested for gemini://
+    URLs. This was copied over from the method that I use for portal.mozz.us.
+
+    Resolved gemini:// URLs are canonicalized, which among other things
+    drops the default port to prevent double-scraping the same resource
+    with and without the port number.
+    """
+
+    def __init__(self, base_url):
+        base_parts = urlparse(base_url)
+        self.netloc = base_parts.netloc
+
+        root_path = pathlib.PurePosixPath(base_parts.path)
+        if not base_parts.path.endswith('/'):
+            root_path = root_path.parent
+        self.root_path = str(root_path)
+
+        # The canonical "gemini://netloc" for links that only have a path,
+        # so they can be built without parsing and canonicalizing the URL.
+        self.prefix = None
+        if self.netloc:
+            try:
+                urlsplit(f'gemini://{self.netloc}').port
+            except ValueError:
+                # canonicalize_url() leaves URLs with an invalid port unchanged
+                pass
+            else:
+                self.prefix = canonicalize_url(f'gemini://{self.netloc}')
+
+    def resolve(self, link_url):
+        # The two most common kinds of links are handled without parsing them
+        # with urllib, and they give the same result as the general case below.
+        if self.prefix and RE_PATH_ONLY.fullmatch(link_url) and not link_url.startswith('//'):
+            path = self.join_path(link_url, link_url)
+            if not path.startswith('/'):
+                path = '/' + path
+            return self.prefix + remove_dot_segments(normalize_percent_encoding(path, PATH_SAFE))
+
+        match = RE_GEMINI_URL.fullmatch(link_url)
+        if match:
+            netloc, path = match.groups()
+            if path:
+                path = self.join_path(path, link_url)
+            return canonicalize_url(f'gemini://{netloc}{path}')
+
+        scheme, netloc, path, params, query, fragment = urlparse(link_url)
+
+        if not scheme:
+            # Unspecified scheme must be interpreted as gemini://
+            scheme = 'gemini'
+        elif scheme != 'gemini':
+            # Leave non-gemini links alone
+            return link_url
+
+        if not netloc:
+            # If netloc is unspecified, use the netloc of the current page
+            netloc = self.netloc
+
+        if path:
+            path = self.join_path(path, link_url)
+
+        return canonicalize_url(urlunparse((scheme, netloc, path, params, query, fragment)))
+
+    def join_path(self, path, link_url):
+        path = normalize_path(posixpath.join(self.root_path, path))
+        if link_url.endswith('/') and not path.endswith('/'):
+            path += '/'
+        return path
+
+
+@functools.lru_cache(maxsize=1024)
+def get_resolver(base_url):
+    """
+    Return the (cached) link resolver for a page, the spider resolves several
+    URLs against the same page outside of its links.
+    """
+    return LinkResolver(base_url)
@@ -1,6 +1,13 @@
 import logging
+import os
+import re
 
+from scrapy import signals
 from scrapy.exceptions import IgnoreRequest
+from twisted.internet.task import LoopingCall
+
+from . import signals as mozz_signals
+from .urlrules import URLRules
 
 logger = logging.getLogger(__name__)
 
@@ -8,19 +15,100 @@ logger = logging.getLogger(__name__)
 class URLDenyMiddleware:
     """
     Downloader middleware that will ignore requests based on URL patterns.
+
+    Rules are taken from the URL_DENY_LIST setting and from the URL_DENY_FILE
+    (one rule per line), see mozz_archiver.urlrules for the syntax. The file
+    is checked for changes every URL_DENY_RELOAD_INTERVAL seconds, so rules
+    can be added to a running crawl.
+
+    The scheduler also calls should_enqueue() for every new request, so that
+    denied URLs are dropped before they're added to the queue. Requests that
+    were already queued are still checked here before they're downloaded.
     """
 
-    def __init__(self, urls, crawler):
-        self.urls = tuple(urls)
+    def __init__(self, urls, crawler, path=None, reload_interval=0):
+        self.urls = list(urls)
         self.crawler = crawler
+        self.path = path
+        self.file_stat = None
+        self.rules = URLRules(self.urls + self.read_file())
+
+        self.reload_loop = None
+        if path and reload_interval:
+            self.reload_loop = LoopingCall(self.reload)
+            crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+            self.reload_interval = reload_interval
 
     @classmethod
     def from_crawler(cls, crawler):
-        urls = crawler.settings.getlist('URL_DENY_LIST', [])
-        return cls(urls, crawler)
+        settings = crawler.settings
+        urls = settings.getlist('URL_DENY_LIST', [])
+        path = settings.get('URL_DENY_FILE')
+        reload_interval = settings.getfloat('URL_DENY_RELOAD_INTERVAL', 30)
+        return cls(urls, crawler, path, reload_interval)
+
+    def spider_opened(self, spider):
+        self.reload_loop.start(self.reload_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.reload_loop.running:
+            self.reload_loop.stop()
+
+    def get_file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read_file(self):
+        if not self.path:
+            return []
+
+        self.file_stat = self.get_file_stat()
+        if self.file_stat is None:
+            logger.warning(f"URL deny file {self.path} does not exist")
+            return []
+
+        with open(self.path) as fp:
+            lines = (line.strip() for line in fp)
+            return [line for line in lines if line and not line.startswith('#')]
+
+    def reload(self):
+        """
+        Recompile the rules if the deny file has changed since it was last read.
+        """
+        if self.get_file_stat() == self.file_stat:
+            return
+
+        try:
+            rules = URLRules(self.urls + self.read_file())
+        except (OSError, re.error) as e:
+            # Keep going with the old rules until the file has been fixed
+            logger.error(f"Unable to reload URL deny file {self.path}: {e}")
+            return
+
+        self.rules = rules
+        logger.info(f"Reloaded URL deny list ({len(rules)} rules)")
+        self.crawler.stats.inc_value('urldeny/reloads')
+
+    def should_enqueue(self, request):
+        """
+        Scheduler hook, return False to drop a request before it's queued.
+        """
+        spider = self.crawler.spider
+        try:
+            self.process_request(request, spider)
+        except IgnoreRequest as e:
+            self.crawler.signals.send_catch_log(
+                mozz_signals.request_rejected, request=request, exception=e, spider=spider
+            )
+            return False
+        return True
 
     def process_request(self, request, spider):
-        if request.url.startswith(self.urls):
+        if self.rules.match(request.url) is not None:
             logger.debug("Forbidden by URL deny list: %(request)s",
                          {'request': request}, extra={'spider': spider})
             self.crawler.stats.inc_value('urldeny/forbidden')
@@ -0,0 +1,230 @@
+"""
+Seed a new crawl with the URLs from the index databases of previous crawls.
+"""
+import logging
+import sqlite3
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from scrapy.http import Request
+
+from .urls import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+# Errors that will come back every time, unless the capsule changes its rules
+BLOCKED_ERRORS = frozenset([
+    'URL forbidden by robots.txt',
+    'URL forbidden by block list',
+    'URL forbidden by trap detector',
+])
+
+# How much weight the capsule's change rate gets compared to a single
+# observation of the page itself
+CAPSULE_PRIOR_WEIGHT = 1.0
+
+# Columns that are read from each index. Indexes built before payload digests
+# were stored are missing the last two, and can only be used to find URLs.
+HISTORY_COLUMNS = ('url', 'response_status', 'error_message', 'payload_digest', 'warc_date')
+
+
+def parse_warc_date(value):
+    """
+    Convert a WARC-Date (with or without microseconds) to a unix timestamp.
+    """
+    if not value:
+        return None
+    dt = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+class URLHistory:
+    """
+    Everything that the previous crawls recorded about a single URL.
+    """
+
+    __slots__ = (
+        'netloc', 'observations', 'failures', 'comparisons', 'changes',
+        'status', 'error', 'digest', 'captured',
+    )
+
+    def __init__(self, netloc):
+        self.netloc = netloc
+        self.observations = 0
+        self.failures = 0
+        self.comparisons = 0
+        self.changes = 0
+        self.status = None
+        self.error = None
+        self.digest = None
+        self.captured = None
+
+    def add(self, status, error, digest, warc_date):
+        """
+        Add the outcome of the URL from the next (newer) crawl.
+        """
+        self.observations += 1
+        if error in BLOCKED_ERRORS or (status or '').startswith('5'):
+            self.failures += 1
+
+        if digest and (status or '').startswith('2'):
+            if self.digest is not None:
+                self.comparisons += 1
+                if digest != self.digest:
+                    self.changes += 1
+            self.digest = digest
+            self.captured = parse_warc_date(warc_date)
+
+        self.status = status
+        self.error = error
+
+    def change_rate(self, capsule_rate):
+        """
+        Estimate how often the page changes between crawls.
+
+        Pages that have only been captured once start out at the rate of the
+        rest of their capsule.
+        """
+        return (self.changes + capsule_rate * CAPSULE_PRIOR_WEIGHT) / (
+            self.comparisons + CAPSULE_PRIOR_WEIGHT
+        )
+
+
+def score_url(history, capsule_rate, now, min_age, max_age):
+    """
+    Return how urgently a URL should be recrawled (0 to 1), or None to skip it.
+
+    - URLs that were a 5x or blocked (robots.txt, deny list, trap) in every
+      crawl are skipped, they can still be found again by following links.
+    - 2x pages are skipped if they were captured less than min_age seconds
+      ago. Otherwise, the score is the page's change rate scaled by how
+      stale the capture is, which reaches its maximum at max_age seconds.
+    - Everything else (redirects, input prompts, temporary failures,
+      connection errors) is rechecked with a score of 0.
+    """
+    if history.failures >= history.observations:
+        return None
+
+    if not (history.status or '').startswith('2'):
+        return 0.0
+
+    age = now - history.captured if history.captured else max_age
+    if age < min_age:
+        return None
+
+    staleness = min(age / max_age, 1.0) if max_age > 0 else 1.0
+    return history.change_rate(capsule_rate) * staleness
+
+
+class RecrawlSeeder:
+    """
+    Build the requests for a recrawl from one or more tools/index-archive
+    databases (RECRAWL_INDEX), listed from the oldest crawl to the newest.
+
+    Each index only holds the latest capture of every URL, so comparing the
+    payload digests between indexes is what tells us how often a page
+    changes. Capsules are ranked by the average change rate of their pages
+    and their requests are generated in that order, which is the order that
+    the scheduler first visits their download slots in. Within a capsule, the
+    request priority is the page's score multiplied by RECRAWL_PRIORITY, so
+    the stalest and most volatile pages are fetched first.
+    """
+
+    def __init__(self, index_paths, min_age=0, max_age=0, max_priority=100, stats=None):
+        self.index_paths = index_paths
+        self.min_age = min_age
+        self.max_age = max_age
+        self.max_priority = max_priority
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            settings.getlist('RECRAWL_INDEX'),
+            settings.getfloat('RECRAWL_MIN_AGE', 86400),
+            settings.getfloat('RECRAWL_MAX_AGE', 90 * 86400),
+            settings.getint('RECRAWL_PRIORITY', 100),
+            crawler.stats,
+        )
+
+    def build_query(self, conn, path):
+        """
+        Select the history columns from an index, with NULL for any that it's missing.
+        """
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(requests);')}
+        if not columns:
+            raise ValueError(f"{path} is not an index database from tools/index-archive")
+
+        missing = [name for name in HISTORY_COLUMNS if name not in columns]
+        if missing:
+            logger.warning(
+                f"{path} was built by an older version of tools/index-archive and is "
+                f"missing {', '.join(missing)}, re-index it to compare pages between crawls"
+            )
+        select = ', '.join(name if name in columns else 'NULL' for name in HISTORY_COLUMNS)
+        return f'SELECT {select} FROM requests;'
+
+    def load_history(self):
+        """
+        Merge the rows from every index into a URL -> URLHistory dict.
+        """
+        history = {}
+        for path in self.index_paths:
+            start = time.monotonic()
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            count = 0
+            try:
+                for url, status, error, digest, warc_date in conn.execute(self.build_query(conn, path)):
+                    # Older indexes may have been built with different URL rules
+                    url = canonicalize_url(url)
+                    entry = history.get(url)
+                    if entry is None:
+                        entry = history[url] = URLHistory(urlparse(url).netloc)
+                    entry.add(status, error, digest, warc_date)
+                    count += 1
+            finally:
+                conn.close()
+            logger.info(f"Loaded {count} URLs from {path} in {time.monotonic() - start:.1f}s")
+        return history
+
+    def get_capsule_rates(self, history):
+        """
+        Average the page change rates for each netloc.
+        """
+        totals = {}
+        for entry in history.values():
+            changes, comparisons = totals.get(entry.netloc, (0, 0))
+            totals[entry.netloc] = (changes + entry.changes, comparisons + entry.comparisons)
+
+        # With nothing to compare (e.g. a single index), every capsule gets 0.5
+        return {
+            netloc: (changes + 0.5) / (comparisons + 1)
+            for netloc, (changes, comparisons) in totals.items()
+        }
+
+    def iter_requests(self):
+        history = self.load_history()
+        capsule_rates = self.get_capsule_rates(history)
+        now = time.time()
+
+        seeds = []
+        for url, entry in history.items():
+            capsule_rate = capsule_rates[entry.netloc]
+            score = score_url(entry, capsule_rate, now, self.min_age, self.max_age)
+            if score is None:
+                if self.stats is not None:
+                    reason = 'recent' if entry.failures < entry.observations else 'failing'
+                    self.stats.inc_value(f'recrawl/skipped/{reason}')
+                continue
+            seeds.append((-capsule_rate, entry.netloc, -score, url))
+        seeds.sort()
+
+        logger.info(
+            f"Seeding {len(seeds)} of {len(history)} URLs from "
+            f"{len(capsule_rates)} capsules in previous crawls"
+        )
+        for _, _, score, url in seeds:
+            priority = round(-score * self.max_priority)
+            yield Request(url, priority=priority, meta={'depth': 0})
@@ -0,0 +1,263 @@
+"""
+Replay backend for serving responses out of the WARC archive.
+
+Requests are looked up in either the sqlite index or the CDXJ index, and the
+response records are read directly from their byte range in the WARC file
+through a pool of open file handles. Decompressed responses are kept in an
+LRU cache that's bounded by the total number of bytes, so popular pages like
+capsule home pages don't need to be re-inflated on every request.
+"""
+import collections
+import io
+import os
+import pathlib
+import sqlite3
+import threading
+
+from warcio.archiveiterator import ArchiveIterator
+
+from .cdxj import ZipNumIndex
+
+# Size of the chunks that are streamed to the client
+CHUNK_SIZE = 2 ** 16
+
+# Size of the reads from the WARC file, most records fit in a single read
+READ_SIZE = 2 ** 20
+
+# Largest decompressed response that's kept in the cache
+MAX_CACHED_SIZE = 2 ** 20
+
+
+class LRUCache:
+    """
+    Least recently used cache of bytes values, bounded by their total size.
+    """
+
+    def __init__(self, max_bytes, max_item_size=None):
+        self.max_bytes = max_bytes
+        self.max_item_size = min(max_item_size or max_bytes, max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_item_size:
+            return
+
+        with self._lock:
+            old_value = self._data.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class FileHandle:
+    """
+    A shared file descriptor that's closed once the pool and all readers
+    are done with it.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.users = 0
+        self.evicted = False
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileHandlePool:
+    """
+    Keep a bounded number of WARC files open between requests.
+
+    Reads use os.pread() so a single descriptor can be shared by several
+    readers without them fighting over the file position.
+    """
+
+    def __init__(self, directory, maxsize=64):
+        self.directory = pathlib.Path(directory)
+        self.maxsize = maxsize
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, filename):
+        with self._lock:
+            handle = self._handles.get(filename)
+            if handle is None:
+                handle = FileHandle(self.directory / filename)
+                self._handles[filename] = handle
+                while len(self._handles) > self.maxsize:
+                    _, evicted = self._handles.popitem(last=False)
+                    evicted.evicted = True
+                    if not evicted.users:
+                        evicted.close()
+            else:
+                self._handles.move_to_end(filename)
+            handle.users += 1
+            return handle
+
+    def release(self, handle):
+        with self._lock:
+            handle.users -= 1
+            if handle.evicted and not handle.users:
+                handle.close()
+
+    def open_range(self, filename, offset, length):
+        reader = RangeReader(self, filename, offset, length)
+        return io.BufferedReader(reader, buffer_size=min(length, READ_SIZE) or 1)
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.evicted = True
+                if not handle.users:
+                    handle.close()
+            self._handles.clear()
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read-only file object for a byte range of a pooled file.
+    """
+
+    def __init__(self, pool, filename, offset, length):
+        super().__init__()
+        self.pool = pool
+        self.handle = pool.acquire(filename)
+        self.start = offset
+        self.end = offset + length
+        self.position = offset
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position - self.start
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.position)
+        if size <= 0:
+            return 0
+        data = os.pread(self.handle.fd, size, self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.pool.release(self.handle)
+        super().close()
+
+
+class ReplayBackend:
+    """
+    Look up URLs in the archive index and stream back the recorded responses.
+    """
+
+    INDEX_SQL = 'SELECT warc_filename, warc_offset, warc_length, error_message FROM requests WHERE url=?'
+
+    def __init__(self, warc_dir, index_db=None, cdxj_dir=None, cache_size=0, max_open_files=64):
+        self.warc_dir = pathlib.Path(warc_dir)
+        self.index_db = index_db
+        self.cdxj_index = None
+        if cdxj_dir:
+            cdxj_dir = pathlib.Path(cdxj_dir)
+            self.cdxj_index = ZipNumIndex(cdxj_dir / 'index.cdxj.gz', cdxj_dir / 'index.idx')
+
+        # Responses bigger than 1/16th of the cache (or MAX_CACHED_SIZE) are
+        # always streamed from disk. A response that's being cached is held in
+        # memory until it finishes, so this also bounds the memory used by
+        # each connection.
+        max_item_size = min(cache_size // 16, MAX_CACHED_SIZE)
+        self.cache = LRUCache(cache_size, max_item_size) if cache_size else None
+        self.pool = FileHandlePool(self.warc_dir, max_open_files)
+
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_db, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def describe(self):
+        if self.cdxj_index is not None:
+            return f'CDXJ index with {len(self.cdxj_index)} blocks'
+
+        c = self.conn.execute('SELECT COUNT(*) FROM requests')
+        return f'WARC index with {c.fetchone()[0]} URLs'
+
+    def lookup(self, url):
+        """
+        Return the WARC location for the (canonicalized) URL, or None.
+        """
+        if self.cdxj_index is None:
+            # The sqlite module keeps the prepared statement in its cache
+            return self.conn.execute(self.INDEX_SQL, (url,)).fetchone()
+
+        capture = self.cdxj_index.lookup_latest(url)
+        if capture:
+            return {
+                'warc_filename': capture['filename'],
+                'warc_offset': capture['offset'],
+                'warc_length': capture['length'],
+                'error_message': None,
+            }
+
+    def iter_response(self, row):
+        """
+        Generate the raw gemini response for an index row in chunks.
+        """
+        key = (row['warc_filename'], row['warc_offset'])
+        if self.cache is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                for i in range(0, len(data), CHUNK_SIZE):
+                    yield data[i:i + CHUNK_SIZE]
+                return
+
+        chunks, size = [], 0
+        cacheable = self.cache is not None
+
+        reader = self.pool.open_range(row['warc_filename'], row['warc_offset'], row['warc_length'])
+        with reader:
+            record = next(iter(ArchiveIterator(reader)))
+            content = record.content_stream()
+            while chunk := content.read(CHUNK_SIZE):
+                if cacheable:
+                    size += len(chunk)
+                    if size > self.cache.max_item_size:
+                        cacheable, chunks = False, []
+                    else:
+                        chunks.append(chunk)
+                yield chunk
+
+        if cacheable:
+            self.cache.set(key, b''.join(chunks))
+
+    def close(self):
+        self.pool.close()
@@ -1,3 +1,5 @@
+import time
+
 from scrapy.resolver import dnscache
 from twisted.internet.interfaces import IHostnameResolver, IResolutionReceiver
 from twisted.internet._resolver import HostResolution
@@ -82,3 +84,50 @@ class CachingHostnameResolver:
             addressTypes,
             transportSemantics,
         )
+
+
+@implementer(IHostnameResolver)
+class TimedHostnameResolver:
+    """
+    Wrap a hostname resolver to measure how long a single lookup takes.
+
+    The callback is called with the start and end time of the lookup once
+    the resolution has completed.
+    """
+
+    def __init__(self, resolver, callback):
+        self.resolver = resolver
+        self.callback = callback
+
+    def resolveHostName(
+        self,
+        resolutionReceiver,
+        hostName,
+        portNumber=0,
+        addressTypes=None,
+        transportSemantics="TCP",
+    ):
+        start_time = time.time()
+        callback = self.callback
+
+        @provider(IResolutionReceiver)
+        class TimedResolutionReceiver:
+
+            def resolutionBegan(self, resolution):
+                resolutionReceiver.resolutionBegan(resolution)
+
+            def addressResolved(self, address):
+                resolutionReceiver.addressResolved(address)
+
+            def resolutionComplete(self):
+                callback(start_time, time.time())
+                resolutionReceiver.resolutionComplete()
+
+        self.resolver.resolveHostName(
+            TimedResolutionReceiver(),
+            hostName,
+            portNumber,
+            addressTypes,
+            transportSemantics,
+        )
+        return resolutionReceiver
@@ -1,10 +1,10 @@
 import logging
-import os
 import pathlib
 from urllib.parse import urlparse
 
 from scrapy.http import Response
 
+from mozz_archiver.links import get_resolver, is_ascii_compatible, iter_links, iter_text_links
 
 logger = logging.getLogger(__name__)
 
@@ -17,15 +17,32 @@ def replace_url_parts(parts, **kwargs):
 class GeminiResponse(Response):
     """
     Response that encapsulates a gemini:// response.
+
+    The body is only populated for responses that the spider might need to
+    look at. The complete raw response (header line + body) is stored in
+    raw_file, which is used to archive the response.
+
+    The header line is parsed and the body is decoded the first time that
+    they're needed, and then cached on the response. Most responses never
+    need to be decoded, because links are extracted from the raw bytes.
     """
 
-    def __init__(self, url, gemini_header, **kwargs):
+    # The scrapy Response class still has a __dict__, but these don't need one
+    __slots__ = ('raw_file', 'gemini_header', '_status', '_meta', '_params', '_text')
+
+    def __init__(self, url, gemini_header, raw_file=None, **kwargs):
         super(GeminiResponse, self).__init__(url, **kwargs)
 
-        self.is_gemini_map = False
+        self.raw_file = raw_file
+        self.gemini_header = gemini_header
+
+        self._status = None
+        self._meta = None
+        self._params = None
         self._text = None
 
-        header = gemini_header.decode('utf-8')
+    def _parse_header(self):
+        header = self.gemini_header.decode('utf-8', errors='replace')
         header_parts = header.strip().split(maxsplit=1)
         if len(header_parts) == 0:
             status, meta = '', ''
@@ -34,42 +51,63 @@ class GeminiResponse(Response):
         else:
             status, meta = header_parts
 
-        params = {}
-        charset = None
-        if status.startswith('2'):
-            for param in meta.split(';'):
-                parts = param.strip().split('=', maxsplit=1)
-                if len(parts) == 2:
-                    params[parts[0].lower()] = parts[1]
-
-            if meta.startswith('text/'):
-                charset = params.get('charset', 'utf-8')
-                try:
-                    self._text = self.body.decode(charset)
-                except Exception as e:
-                    logger.warning(e)
-                    self._text = ""
-
-            if meta.startswith('text/gemini'):
-                self.is_gemini_map = True
+        self._status = status
+        self._meta = meta
 
-        self.gemini_header = gemini_header
-        self.gemini_status = status
-        self.gemini_meta = meta
-        self.gemini_params = params
-        self.charset = charset
+    @property
+    def gemini_status(self):
+        if self._status is None:
+            self._parse_header()
+        return self._status
+
+    @property
+    def gemini_meta(self):
+        if self._meta is None:
+            self._parse_header()
+        return self._meta
+
+    @property
+    def gemini_params(self):
+        if self._params is None:
+            params = {}
+            if self.gemini_status.startswith('2'):
+                for param in self.gemini_meta.split(';'):
+                    parts = param.strip().split('=', maxsplit=1)
+                    if len(parts) == 2:
+                        params[parts[0].lower()] = parts[1]
+            self._params = params
+        return self._params
+
+    @property
+    def charset(self):
+        if self.gemini_status.startswith('2') and self.gemini_meta.startswith('text/'):
+            return self.gemini_params.get('charset', 'utf-8')
+        return None
+
+    @property
+    def is_gemini_map(self):
+        return self.gemini_status.startswith('2') and self.gemini_meta.startswith('text/gemini')
 
     @property
     def text(self):
+        if self._text is None:
+            charset = self.charset
+            if charset is None:
+                return None
+            try:
+                self._text = self.body.decode(charset)
+            except Exception as e:
+                logger.warning(e)
+                self._text = ""
         return self._text
 
     def get_links(self):
         if self.is_gemini_map:
-            for line in self.text.splitlines(keepends=False):
-                if line.startswith('=>'):
-                    link_parts = line[2:].strip().split(maxsplit=1)
-                    if link_parts:
-                        yield link_parts[0]
+            charset = self.charset
+            if is_ascii_compatible(charset):
+                yield from iter_links(self.body, charset)
+            else:
+                yield from iter_text_links(self.text)
 
     def get_parent_url(self):
         """
@@ -93,8 +131,9 @@ class GeminiResponse(Response):
     def follow_all(self, urls=None, gemini_only=True, **kwargs):
         if not urls:
             urls = []
+            resolver = get_resolver(self.url)
             for link in self.get_links():
-                url = self.urljoin(link)
+                url = resolver.resolve(link)
                 if not gemini_only or url.startswith('gemini://'):
                     urls.append(url)
 
@@ -104,48 +143,6 @@ class GeminiResponse(Response):
         """
         Convert potentially relative gemini links into full URLs.
 
-        The base Response class has a method for this, but it doesn't seem to
-        work properly for all of the edge cases that I tested for gemini://
-        URLs. This was copied over from the method that I use for portal.mozz.us.
+        See mozz_archiver.links.LinkResolver for the details.
         """
-        base_parts = urlparse(self.url)
-        link_parts = urlparse(link_url)
-
-        if not link_parts.scheme:
-            # Unspecified scheme must be interpreted as gemini://
-            link_parts = replace_url_parts(link_parts, scheme='gemini')
-        elif link_parts.scheme != 'gemini':
-            # Leave non-gemini links alone
-            return link_url
-
-        if not link_parts.netloc:
-            # If netloc is unspecified, use the netloc of the current page
-            link_parts = replace_url_parts(link_parts, netloc=base_parts.netloc)
-
-        try:
-            port = link_parts.port
-        except ValueError:
-            # Will raise an error if the URL has an invalid port
-            pass
-        else:
-            if port == 1965:
-                # Drop the default port from URLs to prevent double-scraping the
-                # same resource with and without the port number. Technically, there
-                # could be some scenarios where explicitly adding the port to the
-                # URL fetches a different response, but I haven't seen any of these.
-                netloc = link_parts.netloc.rsplit(":", maxsplit=1)[-1]
-                link_parts = replace_url_parts(link_parts, netloc=netloc)
-
-        if link_parts.path:
-            root_path = pathlib.PurePosixPath(base_parts.path)
-            link_path = pathlib.PurePosixPath(link_parts.path)
-            if not base_parts.path.endswith('/'):
-                root_path = root_path.parent
-
-            # noinspection PyTypeChecker
-            path = os.path.normpath(root_path / link_path)
-            if link_url.endswith('/') and not path.endswith('/'):
-                path += '/'
-            link_parts = replace_url_parts(link_parts, path=path)
-
-        return link_parts.geturl()
+        return get_resolver(self.url).resolve(link_url)
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import time
+from collections import deque
+
+from scrapy import signals
+from scrapy.downloadermiddlewares.robotstxt import RobotsTxtMiddleware
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.job import job_dir
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from . import signals as mozz_signals
+
+SQL_INITIALIZE_TABLE = """
+CREATE TABLE IF NOT EXISTS "robots" (
+    netloc TEXT PRIMARY KEY,
+    body BLOB,
+    fetched REAL
+);
+"""
+
+
+class PersistentRobotsTxtMiddleware(RobotsTxtMiddleware):
+    """
+    Robots.txt middleware that keeps the downloaded files in the JOBDIR.
+
+    Scrapy's middleware only holds the parsed rules in memory, so every time
+    a crawl was resumed it would download robots.txt from every host all over
+    again. The body of each robots.txt is also saved to a sqlite table along
+    with the time that it was fetched, and files younger than
+    ROBOTSTXT_CACHE_TTL are parsed from the table instead. Only "2x" and "5x"
+    responses are saved, temporary failures and connection errors will be
+    retried the next time that the crawl is started.
+
+    The scheduler calls should_enqueue() before inserting a new request. If
+    the rules for the host have already been loaded, forbidden URLs are
+    rejected right away instead of taking up a row in the scheduler table.
+    Otherwise, the robots.txt for the host is fetched in the background so
+    that it's ready by the time the first request comes out of the queue,
+    instead of holding up a download slot while it waits for the rules.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.ttl = settings.getfloat('ROBOTSTXT_CACHE_TTL', 86400)
+        self.prefetch_max = settings.getint('ROBOTSTXT_PREFETCH_CONCURRENCY', 8)
+
+        self.prefetch_queue = deque()
+        self.prefetch_pending = set()
+        self.prefetch_active = 0
+
+        self.conn = None
+        jobdir = job_dir(settings)
+        if jobdir and self.ttl > 0:
+            self.conn = self.connect_db(os.path.join(jobdir, 'robots.sqlite3'))
+
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @staticmethod
+    def connect_db(database):
+        conn = sqlite3.connect(database, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        conn.executescript(SQL_INITIALIZE_TABLE)
+        return conn
+
+    def spider_closed(self, spider):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def load_cached(self, netloc):
+        """
+        Load the rules for the host from the cache table, if they haven't expired.
+        """
+        if self.conn is None:
+            return
+
+        c = self.conn.execute('SELECT body, fetched FROM "robots" WHERE netloc=?', (netloc,))
+        row = c.fetchone()
+        if row and row[1] > time.time() - self.ttl:
+            self._parsers[netloc] = self._parserimpl.from_crawler(self.crawler, row[0])
+            self.stats.inc_value('robotstxt/cache_hit_count')
+
+    def robot_parser(self, request, spider):
+        netloc = urlparse_cached(request).netloc
+        if netloc not in self._parsers:
+            self.load_cached(netloc)
+        return super().robot_parser(request, spider)
+
+    def _parse_robots(self, response, netloc, spider):
+        status = getattr(response, 'gemini_status', '')
+        if self.conn is not None and status[:1] in ('2', '5'):
+            self.conn.execute(
+                'INSERT OR REPLACE INTO "robots" (netloc, body, fetched) VALUES (?,?,?);',
+                (netloc, response.body, time.time())
+            )
+        super()._parse_robots(response, netloc, spider)
+
+    def get_crawl_delay(self, request, user_agent):
+        """
+        Return the crawl-delay for the request's host in seconds (0 if there
+        isn't one), or None if its robots.txt hasn't been parsed yet.
+        """
+        rp = self._parsers.get(urlparse_cached(request).netloc)
+        if rp is None or isinstance(rp, Deferred):
+            return None
+
+        # Only the protego parser supports crawl-delay
+        parser = getattr(rp, 'rp', None)
+        if not hasattr(parser, 'crawl_delay'):
+            return 0
+        return parser.crawl_delay(user_agent) or 0
+
+    def should_enqueue(self, request):
+        """
+        Scheduler hook, return False to drop a request before it's queued.
+        """
+        if request.meta.get('dont_obey_robotstxt'):
+            return True
+
+        url = urlparse_cached(request)
+        netloc = url.netloc
+        if netloc not in self._parsers and netloc not in self.prefetch_pending:
+            self.load_cached(netloc)
+            if netloc not in self._parsers:
+                self.prefetch(f'{url.scheme}://{netloc}/', netloc)
+
+        rp = self._parsers.get(netloc)
+        if rp is None or isinstance(rp, Deferred):
+            # The middleware will check the request once the rules are ready
+            return True
+
+        spider = self.crawler.spider
+        try:
+            self.process_request_2(rp, request, spider)
+        except IgnoreRequest as e:
+            self.crawler.signals.send_catch_log(
+                mozz_signals.request_rejected, request=request, exception=e, spider=spider
+            )
+            return False
+        return True
+
+    def prefetch(self, url, netloc):
+        if self.prefetch_max <= 0:
+            return
+
+        self.prefetch_queue.append((url, netloc))
+        self.prefetch_pending.add(netloc)
+        self.start_prefetches()
+
+    def start_prefetches(self):
+        while self.prefetch_queue and self.prefetch_active < self.prefetch_max:
+            url, netloc = self.prefetch_queue.popleft()
+            self.prefetch_pending.discard(netloc)
+            if netloc in self._parsers:
+                # A queued request for the host beat us to it
+                continue
+
+            self.prefetch_active += 1
+            self.stats.inc_value('robotstxt/prefetch_count')
+            d = maybeDeferred(self.robot_parser, Request(url), self.crawler.spider)
+            d.addBoth(self.prefetch_finished)
+
+    def prefetch_finished(self, _):
+        self.prefetch_active -= 1
+        self.start_prefetches()
@@ -27,16 +27,23 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import os
-import hashlib
+import time
+import heapq
+import itertools
 import sqlite3
 import pickle
 import logging
 
+from scrapy.http import Request
 from scrapy.utils.reqser import request_to_dict, request_from_dict
 from scrapy.pqueues import DownloaderInterface
 from scrapy.exceptions import IgnoreRequest
-from scrapy.dupefilters import RFPDupeFilter
 from scrapy import signals
+from twisted.internet.task import LoopingCall
+
+from mozz_archiver.dupefilters import GeminiDupeFilter
+from mozz_archiver.recrawl import RecrawlSeeder
+from mozz_archiver.urls import canonicalize_url
 
 logger = logging.getLogger(__name__)
 
@@ -47,24 +54,325 @@ CREATE TABLE IF NOT EXISTS "scheduler" (
     slot TEXT,
     priority INTEGER,
     url TEXT,
-    request_data BLOB
+    request_data BLOB,
+    depth INTEGER,
+    redirects INTEGER,
+    referer TEXT,
+    codec INTEGER
 );
 CREATE INDEX IF NOT EXISTS request_state_index
     ON "scheduler" (downloading, slot, priority);
+CREATE TABLE IF NOT EXISTS "slots" (
+    slot TEXT PRIMARY KEY,
+    requests INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS scheduler_insert_slot AFTER INSERT ON "scheduler"
+BEGIN
+    INSERT OR IGNORE INTO "slots" (slot, requests) VALUES (NEW.slot, 0);
+    UPDATE "slots" SET requests = requests + 1 WHERE slot = NEW.slot;
+END;
+CREATE TRIGGER IF NOT EXISTS scheduler_delete_slot AFTER DELETE ON "scheduler"
+BEGIN
+    UPDATE "slots" SET requests = requests - 1 WHERE slot = OLD.slot;
+    DELETE FROM "slots" WHERE slot = OLD.slot AND requests <= 0;
+END;
 """
 
+# Columns that have been added to the "scheduler" table since it was created,
+# these will be appended to the tables in existing job directories.
+SQL_SCHEDULER_COLUMNS = {
+    'depth': 'INTEGER',
+    'redirects': 'INTEGER',
+    'referer': 'TEXT',
+    'codec': 'INTEGER',
+}
+
+# Formats for the request_data column. Rows from older job directories don't
+# have a codec and are treated as CODEC_PICKLE.
+CODEC_PICKLE = 0  # The entire request_to_dict() output, pickled
+CODEC_COMPACT = 1  # Columns for the common fields, and pickled leftovers
+
+# The request_to_dict() values for a plain Request(url)
+REQUEST_DICT_DEFAULTS = {
+    'callback': None,
+    'errback': None,
+    'method': 'GET',
+    'headers': {},
+    'body': b'',
+    'cookies': {},
+    'meta': {},
+    '_encoding': 'utf-8',
+    'dont_filter': False,
+    'flags': [],
+    'cb_kwargs': {},
+}
+
+
+def compact_request_dict(request_dict):
+    """
+    Split a request_to_dict() dictionary into the compact scheduler columns.
+
+    Nearly every queued gemini request is a plain GET with a depth, a referer,
+    and maybe a redirect counter. Those are stored in their own columns, and
+    anything that differs from the defaults is pickled into a (usually empty)
+    leftover blob.
 
-class GeminiDupeFilter(RFPDupeFilter):
+    Returns a (depth, redirects, referer, request_data) tuple.
+    """
+    extra = {}
+    depth, redirects, referer = None, None, None
+    for key, value in request_dict.items():
+        if key in ('url', 'priority'):
+            continue
+        elif key == 'meta':
+            meta = dict(value)
+            if isinstance(meta.get('depth'), int):
+                depth = meta.pop('depth')
+            if isinstance(meta.get('redirects'), int):
+                redirects = meta.pop('redirects')
+            if meta:
+                extra['meta'] = meta
+        elif key == 'headers':
+            headers = dict(value)
+            values = headers.get(b'Referer')
+            if values and len(values) == 1:
+                referer = headers.pop(b'Referer')[0].decode('latin-1')
+            if headers:
+                extra['headers'] = headers
+        elif key not in REQUEST_DICT_DEFAULTS or value != REQUEST_DICT_DEFAULTS[key]:
+            extra[key] = value
+
+    request_data = pickle.dumps(extra) if extra else None
+    return depth, redirects, referer, request_data
+
+
+def expand_request_dict(url, priority, depth, redirects, referer, request_data):
+    """
+    Rebuild the request_to_dict() dictionary from the compact scheduler columns.
+    """
+    request_dict = {
+        key: value.copy() if isinstance(value, (dict, list)) else value
+        for key, value in REQUEST_DICT_DEFAULTS.items()
+    }
+    if request_data:
+        request_dict.update(pickle.loads(request_data))
+
+    request_dict['url'] = url
+    request_dict['priority'] = priority
+    if depth is not None:
+        request_dict['meta']['depth'] = depth
+    if redirects is not None:
+        request_dict['meta']['redirects'] = redirects
+    if referer is not None:
+        request_dict['headers'][b'Referer'] = [referer.encode('latin-1')]
+    return request_dict
+
+
+class SlotIndex:
     """
-    Custom dupefilter that generates unique SHAs for gemini URLs.
+    In-memory index of the download slots that have requests waiting.
+
+    Slots are stored in a heap ordered by their number of active downloads,
+    so the least busy slot can be found without scanning the scheduler table.
+    Ties are broken by the order that slots were (re-)inserted into the heap,
+    which rotates through domains with the same load in a round-robin fashion.
+
+    Heap entries are invalidated lazily. Every slot has at most one valid
+    entry at a time, identified by its sequence number, and stale entries are
+    discarded when they bubble up to the top of the heap.
+
+    Slots that can't accept another download yet (e.g. because of a download
+    delay) can be parked until a given time, or until one of their active
+    downloads finishes, so that they don't block the other slots.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.active = {}
+        self.total_pending = 0
+
+        self._entries = {}
+        self._heap = []
+        self._counter = itertools.count()
 
-    Necessary because I don't want to apply the same canonicalize method that
-    scrapy uses for HTTP requests.
+        self.parked = {}
+        self._parked_heap = []
+
+    def __len__(self):
+        return self.total_pending
+
+    def load(self, slot_counts):
+        """
+        Reset the index from (slot, number of queued requests) pairs.
+        """
+        self.pending = {}
+        self.active = {}
+        self.total_pending = 0
+        self._entries = {}
+        self._heap = []
+        self.parked = {}
+        self._parked_heap = []
+        for slot, count in slot_counts:
+            if count > 0:
+                self.pending[slot] = count
+                self.total_pending += count
+                self._push(slot)
+
+    def add(self, slot):
+        """
+        A new request has been queued for the slot.
+        """
+        self.pending[slot] = self.pending.get(slot, 0) + 1
+        self.total_pending += 1
+        if slot not in self._entries and slot not in self.parked:
+            self._push(slot)
+
+    def start(self, slot):
+        """
+        A queued request has been handed off to the downloader.
+        """
+        self.pending[slot] -= 1
+        self.total_pending -= 1
+        self.active[slot] = self.active.get(slot, 0) + 1
+        if self.pending[slot] > 0:
+            self._push(slot)
+        else:
+            del self.pending[slot]
+            self._entries.pop(slot, None)
+
+    def finish(self, slot):
+        """
+        An active download has been removed from the scheduler.
+        """
+        active = self.active.get(slot, 0) - 1
+        if active > 0:
+            self.active[slot] = active
+        else:
+            self.active.pop(slot, None)
+
+        self.parked.pop(slot, None)
+        if slot in self.pending:
+            self._push(slot)
+
+    def discard(self, slot):
+        """
+        Drop a slot that turned out to have no queued requests left.
+        """
+        self.total_pending -= self.pending.pop(slot, 0)
+        self._entries.pop(slot, None)
+        self.parked.pop(slot, None)
+
+    def park(self, slot, until):
+        """
+        Hide the slot until the given time.monotonic() value, or until one of
+        its active downloads finishes (whichever comes first).
+        """
+        self._entries.pop(slot, None)
+        self.parked[slot] = until
+        if until != float('inf'):
+            heapq.heappush(self._parked_heap, (until, slot))
+
+    def next_unpark_time(self):
+        """
+        Return the earliest time that a parked slot will become available.
+        """
+        heap = self._parked_heap
+        while heap:
+            until, slot = heap[0]
+            if self.parked.get(slot) == until:
+                return until
+            heapq.heappop(heap)
+        return None
+
+    def unpark(self, now):
+        """
+        Return any parked slots whose time has come back to the heap.
+        """
+        heap = self._parked_heap
+        while heap and heap[0][0] <= now:
+            until, slot = heapq.heappop(heap)
+            if self.parked.get(slot) == until:
+                del self.parked[slot]
+                if slot in self.pending:
+                    self._push(slot)
+
+    def next_slot(self):
+        """
+        Return the slot with the fewest active downloads, without removing it.
+        """
+        heap = self._heap
+        while heap:
+            _, seq, slot = heap[0]
+            if self._entries.get(slot) == seq:
+                return slot
+            heapq.heappop(heap)
+        return None
+
+    def _push(self, slot):
+        seq = next(self._counter)
+        self._entries[slot] = seq
+        heapq.heappush(self._heap, (self.active.get(slot, 0), seq, slot))
+
+        # Stale entries are normally popped off of the top of the heap, but
+        # they can pile up underneath busy slots. Rebuild the heap before it
+        # grows too far beyond the number of slots.
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [
+                (self.active.get(s, 0), seq, s) for s, seq in self._entries.items()
+            ]
+            heapq.heapify(self._heap)
+
+
+class CommitBatcher:
     """
-    def request_fingerprint(self, request):
-        fp = hashlib.sha1()
-        fp.update(request.url.encode('utf-8'))
-        return fp.hexdigest()
+    Group writes to the scheduler database into shared transactions.
+
+    With a commit interval of zero, every scheduler operation is committed as
+    soon as it finishes. This is the safest mode, because a crash can't lose
+    any queued requests. Otherwise, operations are grouped together and
+    committed after either batch_size operations or interval seconds,
+    whichever comes first. A crash will lose everything since the last commit,
+    which means that recently discovered URLs may never be crawled and
+    recently finished URLs may be crawled twice.
+    """
+
+    def __init__(self, conn, interval=0, batch_size=1000):
+        self.conn = conn
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.operations = 0
+        self.started = 0
+        self.commit_callbacks = []
+
+    def execute(self, sql, params=()):
+        """
+        Execute a write statement inside of the current batch transaction.
+        """
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE TRANSACTION')
+            self.started = time.monotonic()
+        return self.conn.execute(sql, params)
+
+    def operation_done(self):
+        """
+        Mark the end of a scheduler operation, and commit if the batch is full.
+        """
+        if not self.conn.in_transaction:
+            return
+
+        self.operations += 1
+        if self.operations >= self.batch_size:
+            self.commit()
+        elif time.monotonic() - self.started >= self.interval:
+            self.commit()
+
+    def commit(self):
+        if self.conn.in_transaction:
+            self.conn.execute('COMMIT')
+            for callback in self.commit_callbacks:
+                callback()
+        self.operations = 0
 
 
 class Scheduler(object):
@@ -80,48 +388,146 @@ class Scheduler(object):
     This class is loosely based off the scrapy-sqlite package but I ended up
     changing quite a bit. It prioritizes breadth-first domain crawling in the
     same way as the DownloaderAwarePriorityQueue.
+
+    The number of queued and active requests for each slot is tracked in
+    memory by a SlotIndex, so picking the next slot doesn't need to touch the
+    scheduler table. A set of triggers keeps the per-slot request counts in
+    the "slots" table up to date in the same transaction as every insert and
+    delete, which is used to rebuild the index when the crawl is resumed.
+
+    By default, every scheduler operation is committed to disk immediately.
+    The SCHEDULER_COMMIT_INTERVAL setting can be used to trade some of that
+    durability for speed by batching writes together (see CommitBatcher).
+
+    When RECRAWL_INDEX is set, a new job is seeded with the URLs from the
+    index databases of previous crawls before it starts (see RecrawlSeeder).
     """
 
-    def __init__(self, dupefilter, conn, stats, downloader_interface, crawler):
+    # Number of seed requests to insert with each executemany() call
+    seed_batch_size = 10_000
+
+    def __init__(self, dupefilter, conn, stats, downloader_interface, crawler, batcher):
         self.dupefilter = dupefilter
         self.conn = conn
         self.stats = stats
         self.downloader_interface = downloader_interface
         self.crawler = crawler
+        self.batcher = batcher
+
+        self.slot_index = SlotIndex()
+        self.saturation_checks = self.find_hooks('is_saturated')
+        self.slot_wait_hooks = self.find_hooks('get_slot_wait')
+        self.enqueue_checks = self.find_hooks('should_enqueue')
+
+        self.batcher.commit_callbacks.append(self.on_commit)
+        self.commit_loop = LoopingCall(self.batcher.commit)
 
         crawler.signals.connect(
             self.on_request_left_downloader, signal=signals.request_left_downloader
         )
 
     @staticmethod
-    def connect_db(database):
+    def connect_db(database, synchronous='FULL'):
         conn = sqlite3.connect(database, isolation_level=None)
         conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute(f'PRAGMA synchronous={synchronous};')
         conn.executescript(SQL_INITIALIZE_TABLE)
+
+        c = conn.execute('PRAGMA table_info("scheduler");')
+        columns = {row['name'] for row in c}
+        for name, column_type in SQL_SCHEDULER_COLUMNS.items():
+            if name not in columns:
+                conn.execute(f'ALTER TABLE "scheduler" ADD COLUMN {name} {column_type};')
         return conn
 
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
 
-        dupefilter = GeminiDupeFilter.from_settings(settings)
-
         jobdir = settings.get('JOBDIR')
         if jobdir:
-            dbname = '{spider}.sqlite3'.format(spider=crawler.spider.name)
-            database = os.path.join(jobdir, dbname)
+            jobdir_prefix = os.path.join(jobdir, crawler.spider.name)
+            database = '{prefix}.sqlite3'.format(prefix=jobdir_prefix)
         else:
+            jobdir_prefix = None
             database = ":memory:"
 
+        commit_interval = settings.getfloat('SCHEDULER_COMMIT_INTERVAL', 0)
+        commit_batch_size = settings.getint('SCHEDULER_COMMIT_BATCH_SIZE', 1000)
+
+        # In WAL mode, synchronous=NORMAL is still safe against the process
+        # crashing. It only risks losing the latest commits on a power failure,
+        # which is already the tradeoff that batched commits are making.
+        synchronous = 'NORMAL' if commit_interval else 'FULL'
+
         downloader_interface = DownloaderInterface(crawler)
-        conn = cls.connect_db(database)
-        return cls(dupefilter, conn, crawler.stats, downloader_interface, crawler)
+        conn = cls.connect_db(database, synchronous)
+        batcher = CommitBatcher(conn, commit_interval, commit_batch_size)
+        dupefilter = GeminiDupeFilter.from_settings(settings, batcher, jobdir_prefix)
+        return cls(dupefilter, conn, crawler.stats, downloader_interface, crawler, batcher)
+
+    def find_hooks(self, name):
+        """
+        Return the bound method with the given name from every extension and
+        downloader middleware that defines one.
+
+        This lets components plug into the scheduler without the scheduler
+        needing to know about them ahead of time.
+        """
+        components = list(self.crawler.extensions.middlewares)
+        if self.crawler.engine:
+            components.extend(self.crawler.engine.downloader.middleware.middlewares)
+
+        hooks = []
+        for component in components:
+            method = getattr(component, name, None)
+            if method is not None:
+                hooks.append(method)
+        return hooks
+
+    def is_saturated(self):
+        """
+        Check if any extension has asked for new downloads to be paused.
+
+        For example, the WARC exporter will pause the crawl while its write
+        queue is backed up. The engine will retry the scheduler on its next
+        heartbeat or when an active download finishes.
+        """
+        return any(check() for check in self.saturation_checks)
+
+    def should_enqueue(self, request):
+        """
+        Check if every component will accept the request before it's queued.
+
+        For example, the robots.txt middleware will reject URLs that are
+        forbidden by rules that it has already loaded for the host, instead
+        of letting them sit in the queue until they reach the downloader.
+        Hooks may also lower the priority of a request that they accept.
+        They're only called for requests that got past the dupefilter.
+        """
+        return all(check(request) for check in self.enqueue_checks)
+
+    def get_slot_wait(self, slot):
+        """
+        Return how many seconds to wait before the slot can start another download.
+        """
+        wait = 0
+        for hook in self.slot_wait_hooks:
+            wait = max(wait, hook(slot))
+        return wait
+
+    def wake_engine(self, delay):
+        """
+        Ask the engine to come back for the next request after the delay,
+        instead of waiting for its next heartbeat.
+        """
+        engine = self.crawler.engine
+        if engine and engine.slot:
+            engine.slot.nextcall.schedule(delay)
 
     def __len__(self):
-        c = self.conn.execute('SELECT COUNT(*) FROM "scheduler" WHERE downloading=false;')
-        result = c.fetchone()
-        if result:
-            return int(result[0])
+        return len(self.slot_index)
 
     def has_pending_requests(self):
         return bool(len(self))
@@ -130,24 +536,144 @@ class Scheduler(object):
         self.spider = spider
 
         # Reschedule any unfinished downloads
-        self.conn.execute('UPDATE "scheduler" SET downloading=false;')
+        self.batcher.execute('UPDATE "scheduler" SET downloading=false;')
+        self.batcher.commit()
+        seed = self.crawler.settings.getlist('RECRAWL_INDEX') and self.is_new_job()
+        self.dupefilter.open()
+        if seed:
+            self.seed_requests(RecrawlSeeder.from_crawler(self.crawler).iter_requests())
+        self.load_slot_index()
+        self.batcher.commit()
+
+        if self.batcher.interval:
+            self.commit_loop.start(self.batcher.interval, now=False)
 
         if self.has_pending_requests():
             spider.log("Resuming crawl ({} requests scheduled)".format(len(self)))
 
     def close(self, reason):
+        if self.commit_loop.running:
+            self.commit_loop.stop()
+        self.batcher.commit()
+        self.dupefilter.close(reason)
+        self.stats.set_value(
+            'dupefilter/false_positives', self.dupefilter.false_positives, spider=self.spider
+        )
         self.conn.close()
 
+    def on_commit(self):
+        self.stats.inc_value('scheduler/commits', spider=self.spider)
+
+    def is_new_job(self):
+        c = self.conn.execute(
+            'SELECT EXISTS (SELECT 1 FROM "scheduler") OR EXISTS (SELECT 1 FROM "seen");'
+        )
+        return not c.fetchone()[0]
+
+    def seed_requests(self, requests):
+        """
+        Bulk load requests into the queue before the crawl starts.
+
+        This skips the per-request statements in enqueue_request(). Seeds
+        are still checked by the should_enqueue() hooks, and their
+        fingerprints are added to the dupefilter in the same transaction.
+        The requests must have unique URLs. Slots are created in the order
+        that the requests are generated.
+        """
+        rows, fingerprints, count = [], [], 0
+        for request in requests:
+            if not self.should_enqueue(request):
+                self.stats.inc_value('scheduler/rejected', spider=self.spider)
+                continue
+
+            depth, redirects, referer, request_data = self.encode_request(request)
+            slot = self.downloader_interface.get_slot_key(request)
+            rows.append((
+                False, slot, request.priority, canonicalize_url(request.url),
+                depth, redirects, referer, request_data, CODEC_COMPACT,
+            ))
+            fingerprints.append(self.dupefilter.request_fingerprint(request))
+            if len(rows) >= self.seed_batch_size:
+                count += self.insert_seeds(rows, fingerprints)
+                rows, fingerprints = [], []
+
+        if rows:
+            count += self.insert_seeds(rows, fingerprints)
+        self.stats.inc_value('scheduler/seeded', count, spider=self.spider)
+        logger.info(f"Seeded the scheduler with {count} requests")
+
+    def insert_seeds(self, rows, fingerprints):
+        self.conn.execute('BEGIN IMMEDIATE TRANSACTION')
+        self.conn.executemany(
+            'INSERT INTO "scheduler" '
+            '(downloading, slot, priority, url, depth, redirects, referer, request_data, codec) '
+            'VALUES (?,?,?,?,?,?,?,?,?);',
+            rows,
+        )
+        self.dupefilter.insert_fingerprints(fingerprints)
+        self.conn.execute('COMMIT')
+        return len(rows)
+
+    def load_slot_index(self):
+        """
+        Rebuild the in-memory slot index from the "slots" table.
+        """
+        c = self.conn.execute('SELECT EXISTS (SELECT 1 FROM "slots");')
+        has_slots = c.fetchone()[0]
+        c = self.conn.execute('SELECT EXISTS (SELECT 1 FROM "scheduler");')
+        has_requests = c.fetchone()[0]
+
+        if has_requests and not has_slots:
+            # Queue files created before the "slots" table existed need to
+            # have their slot counts backfilled with a one-time table scan.
+            logger.info("Rebuilding scheduler slot counts")
+            self.batcher.execute('DELETE FROM "slots";')
+            self.batcher.execute(
+                'INSERT INTO "slots" (slot, requests) '
+                'SELECT slot, COUNT(*) FROM "scheduler" GROUP BY slot;'
+            )
+
+        # Slots are visited in the order that they were created, which is
+        # how a recrawl puts the most volatile capsules first.
+        c = self.conn.execute('SELECT slot, requests FROM "slots" ORDER BY rowid;')
+        self.slot_index.load(c)
+
     def begin_immediate_transaction(self, cursor):
         cursor.execute('BEGIN IMMEDIATE TRANSACTION')
 
     def encode_request(self, request):
+        """
+        Return the (depth, redirects, referer, request_data) column values.
+        """
         request_dict = request_to_dict(request, self.spider)
-        return pickle.dumps(request_dict)
-
-    def decode_request(self, request_data):
-        request_dict = pickle.loads(request_data)
-        return request_from_dict(request_dict, self.spider)
+        return compact_request_dict(request_dict)
+
+    def decode_request(self, row):
+        if not row['codec']:
+            request_dict = pickle.loads(row['request_data'])
+            return request_from_dict(request_dict, self.spider)
+
+        if row['request_data']:
+            request_dict = expand_request_dict(
+                row['url'],
+                row['priority'],
+                row['depth'],
+                row['redirects'],
+                row['referer'],
+                row['request_data'],
+            )
+            return request_from_dict(request_dict, self.spider)
+
+        # Fast path for plain requests, skip building the intermediate dict
+        meta = {}
+        if row['depth'] is not None:
+            meta['depth'] = row['depth']
+        if row['redirects'] is not None:
+            meta['redirects'] = row['redirects']
+        headers = {}
+        if row['referer'] is not None:
+            headers[b'Referer'] = row['referer'].encode('latin-1')
+        return Request(row['url'], priority=row['priority'], meta=meta, headers=headers)
 
     def enqueue_request(self, request):
 
@@ -155,59 +681,89 @@ class Scheduler(object):
         # re-enqueuing after something like a connection timeout retry
         self.remove_request(request)
 
-        request_data = self.encode_request(request)
-        slot = self.downloader_interface.get_slot_key(request)
-
+        # Duplicates are filtered first, so a rejected URL is only reported
+        # once and the hooks don't run again for every link to it
         if not request.dont_filter and self.dupefilter.request_seen(request):
             self.dupefilter.log(request, self.spider)
+            self.batcher.operation_done()
+            return False
+
+        if not self.should_enqueue(request):
+            self.batcher.operation_done()
+            self.stats.inc_value('scheduler/rejected', spider=self.spider)
             return False
 
-        self.dupefilter.file.flush()
+        depth, redirects, referer, request_data = self.encode_request(request)
+        slot = self.downloader_interface.get_slot_key(request)
 
-        c = self.conn.cursor()
-        c.execute(
-            'INSERT INTO "scheduler" VALUES (?,?,?,?,?);',
-            (False, slot, request.priority, request.url, request_data)
+        self.batcher.execute(
+            'INSERT INTO "scheduler" '
+            '(downloading, slot, priority, url, depth, redirects, referer, request_data, codec) '
+            'VALUES (?,?,?,?,?,?,?,?,?);',
+            (False, slot, request.priority, canonicalize_url(request.url),
+             depth, redirects, referer, request_data, CODEC_COMPACT)
         )
+        self.batcher.operation_done()
+        self.slot_index.add(slot)
         self.stats.inc_value('scheduler/enqueued', spider=self.spider)
         return True
 
     def next_request(self):
-        # Prioritize the slot that has the minimum number of active downloads
-        c = self.conn.cursor()
-        c.execute(
-            'SELECT slot FROM "scheduler" GROUP BY slot '
-            'ORDER BY SUM(downloading) LIMIT 1;'
-        )
-        rows = c.fetchone()
-        if not rows:
+        if self.is_saturated():
             return None
 
-        slot = rows[0]
+        now = time.monotonic()
+        self.slot_index.unpark(now)
 
-        c = self.conn.cursor()
-        c.execute(
-            'SELECT rowid, request_data FROM "scheduler" '
-            'WHERE downloading=? AND slot=? '
-            'ORDER BY priority DESC LIMIT 1',
-            (False, slot)
-        )
-        row = c.fetchone()
-        if not row:
-            return None
+        # Prioritize the slot that has the minimum number of active downloads
+        while True:
+            slot = self.slot_index.next_slot()
+            if slot is None:
+                unpark_time = self.slot_index.next_unpark_time()
+                if unpark_time is not None:
+                    self.wake_engine(max(unpark_time - now, 0))
+                return None
+
+            wait = self.get_slot_wait(slot)
+            if wait > 0:
+                if wait == float('inf') and not self.slot_index.active.get(slot):
+                    # The slot is busy with downloads that didn't come from the
+                    # scheduler (e.g. robots.txt), so there's nothing to wait on.
+                    wait = 1
+                self.slot_index.park(slot, now + wait)
+                continue
+
+            c = self.conn.cursor()
+            c.execute(
+                'SELECT rowid, url, priority, depth, redirects, referer, request_data, codec '
+                'FROM "scheduler" WHERE downloading=? AND slot=? '
+                'ORDER BY priority DESC LIMIT 1',
+                (False, slot)
+            )
+            row = c.fetchone()
+            if row:
+                break
+
+            # The index thinks that there are requests waiting in this slot
+            # but the table disagrees, trust the table and move on.
+            logger.warning(f"Scheduler slot index out of sync for slot {slot}")
+            self.slot_index.discard(slot)
 
-        row_id, request_data = row
-        self.conn.execute(
+        row_id = row['rowid']
+        self.batcher.execute(
             'UPDATE "scheduler" SET downloading=? WHERE rowid=?',
             (True, row_id)
         )
+        self.batcher.operation_done()
+        self.slot_index.start(slot)
 
-        request = self.decode_request(request_data)
+        request = self.decode_request(row)
         self.stats.inc_value('scheduler/dequeued/sqlite', spider=self.spider)
 
-        # Stash the row id so we can delete the request from the table once it
-        # has either finished downloading or raised an exception.
+        # Stash the row id and slot so we can delete the request from the table
+        # once it has either finished downloading or raised an exception.
         request.row_id = row_id
+        request.slot_key = slot
 
         # If a request is rejected by the downloader middleware, it will never
         # reach the downloader to trigger the request left downloader signal.
@@ -223,14 +779,18 @@ class Scheduler(object):
     def on_request_error(self, failure):
         if failure.check(IgnoreRequest):
             self.remove_request(failure.request)
+            self.batcher.operation_done()
 
     def on_request_left_downloader(self, request, *_):
         self.remove_request(request)
+        self.batcher.operation_done()
 
     def remove_request(self, request):
         request.errback = None
         if hasattr(request, 'row_id'):
-            self.conn.execute(
+            self.batcher.execute(
                 'DELETE FROM "scheduler" WHERE rowid=?', (request.row_id,)
             )
+            self.slot_index.finish(request.slot_key)
             del request.row_id
+            del request.slot_key
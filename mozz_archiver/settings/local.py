@@ -14,6 +14,14 @@ USER_AGENT = f'archiver-mozz'
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
+# Max age (in secs) of the robots.txt files that are saved in the JOBDIR and
+# reused when the crawl is resumed (0 to disable)
+ROBOTSTXT_CACHE_TTL = 86400  # 1 day
+
+# Max number of robots.txt files to download at once for newly discovered
+# hosts, ahead of their first queued request (0 to disable)
+ROBOTSTXT_PREFETCH_CONCURRENCY = 8
+
 # Print WARC export to stdout instead of a file
 WARC_DEBUG = False
 
@@ -26,12 +34,41 @@ WARC_FILE_MAX_SIZE = 1_000_000_000  # 1 GB
 # Prefix to append to the beginning of WARC filenames
 WARC_FILE_PREFIX = "test"
 
-# Directory to save WARC files
-WARC_FILE_DIRECTORY = None
+# Directory to save WARC files. This can also be a list of directories (e.g.
+# on separate disks), and the shards will be spread evenly between them.
+WARC_FILE_DIRECTORY = '.'
+
+# Number of WARC files to write in parallel, each with its own writer thread
+WARC_SHARDS = 1
+
+# How responses are assigned to shards, either "netloc" to keep all of the
+# captures from a site in the same files, or "round-robin"
+WARC_SHARD_BY = 'netloc'
 
 # Add a WARC metadata record with some additional info for each request
 WARC_WRITE_METADATA = False
 
+# Max number of responses waiting to be written by the WARC writer thread.
+# New downloads are paused once the queue is half full, and the reactor will
+# block if it fills up completely.
+WARC_WRITER_QUEUE_SIZE = 100
+
+# Write a "revisit" record instead of a full response when the same payload
+# has already been archived. Payload digests are indexed in the JOBDIR, and
+# can be seeded from a previous crawl's tools/index-archive database.
+# Responses smaller than the min size aren't worth replacing, because the
+# revisit record's headers alone take up a few hundred bytes.
+WARC_DEDUP_ENABLED = True
+WARC_DEDUP_SEED_INDEX = None
+WARC_DEDUP_MIN_SIZE = 1024
+
+# Write a structured record for the outcome of every request to a gzipped
+# JSON lines file, which tools/index-archive can read with --event-log
+EVENT_LOG_ENABLED = True
+EVENT_LOG_DIRECTORY = '.'
+EVENT_LOG_MAX_SIZE = 100_000_000  # 100 MB
+EVENT_LOG_QUEUE_SIZE = 10_000
+
 # These params will be placed into the generated "warcinfo" record
 WARC_VERSION = "WARC/1.1"
 WARC_OPERATOR = 'Michael Lazar (michael@mozz.us)'
@@ -42,6 +79,7 @@ WARC_CONFORMS_TO = 'http://iipc.github.io/warc-specifications/specifications/war
 
 EXTENSIONS = {
     'mozz_archiver.extensions.WARCExporter': 0,
+    'mozz_archiver.traps.TrapDetector': 100,
 }
 
 DOWNLOAD_HANDLERS = {
@@ -51,6 +89,10 @@ DOWNLOAD_HANDLERS = {
 # Disable a bunch of unnecessary middleware for gemini://
 DOWNLOADER_MIDDLEWARES = {
     'mozz_archiver.middleware.URLDenyMiddleware': 50,
+    'mozz_archiver.robots.PersistentRobotsTxtMiddleware': 100,
+    'mozz_archiver.eventlog.CrawlEventLog': 500,
+    'mozz_archiver.throttle.AdaptiveThrottle': 900,
+    'scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware': None,
     'scrapy.downloadermiddlewares.httpauth.HttpAuthMiddleware': None,
     'scrapy.downloadermiddlewares.defaultheaders.DefaultHeadersMiddleware': None,
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
@@ -69,15 +111,42 @@ CONCURRENT_REQUESTS_PER_DOMAIN = 1
 # See also autothrottle settings and docs
 DOWNLOAD_DELAY = 2
 
+# Adapt the delay and concurrency of each host based on its response times,
+# errors and "44 SLOW DOWN" responses. Hosts start at DOWNLOAD_DELAY and
+# CONCURRENT_REQUESTS_PER_DOMAIN and are tuned from there.
+THROTTLE_ENABLED = True
+
+# Bounds for the per-host delay (in secs). A robots.txt crawl-delay or a
+# 44 SLOW DOWN response can still push a host past the max delay.
+THROTTLE_MIN_DELAY = 0.5
+THROTTLE_MAX_DELAY = 60
+
+# Max number of concurrent downloads for a single host
+THROTTLE_MAX_CONCURRENCY = 4
+
+# Only hosts with an average response time (in secs) below this will be given
+# more concurrency, and hosts above twice this will have it taken away
+THROTTLE_TARGET_LATENCY = 1.0
+
 # The maximum response size (in bytes) that downloader will download.
 DOWNLOAD_MAXSIZE = 100_000_000  # 100 MB
 
 # The response size (in bytes) that downloader will start to warn.
 DOWNLOAD_WARNSIZE = 32_000_000  # 32 MB
 
+# Responses larger than this size (in bytes) are spooled to a temporary file
+# instead of being buffered in memory. Only gemtext bodies are loaded into
+# memory past this size, since they need to be parsed for links.
+DOWNLOAD_SPOOLSIZE = 1_000_000  # 1 MB
+
 # The amount of time (in secs) that the downloader will wait before timing out.
 DOWNLOAD_TIMEOUT = 60
 
+# Max number of hosts to keep TLS sessions for, so that repeat connections to
+# the same capsule can resume the session instead of doing a full handshake
+# (0 to disable).
+TLS_SESSION_CACHE_SIZE = 10_000
+
 # Disable cookies (enabled by default)
 COOKIES_ENABLED = False
 
@@ -105,6 +174,80 @@ TELNETCONSOLE_PASSWORD = "password"
 
 SCHEDULER = "mozz_archiver.scheduler.Scheduler"
 
+# Max number of seconds that scheduler writes can be batched together before
+# they are committed to disk. Setting this to 0 will commit every operation
+# immediately, which guarantees that no URLs are lost if the crawler crashes.
+SCHEDULER_COMMIT_INTERVAL = 0
+
+# Max number of scheduler operations that can be batched into a single commit
+SCHEDULER_COMMIT_BATCH_SIZE = 1000
+
 DUPEFILTER_DEBUG = False
 
+# Expected number of unique URLs in the crawl, used to size the dupefilter's
+# in-memory bloom filter
+DUPEFILTER_CAPACITY = 10_000_000
+
+# Target false positive rate for the bloom filter. False positives never cause
+# a URL to be skipped, they only cost an extra lookup in the sqlite table.
+DUPEFILTER_ERROR_RATE = 0.01
+
+# Upper limit for the size of the bloom filter in bytes (0 for no limit)
+DUPEFILTER_MAX_MEMORY = 64_000_000
+
+# Seed a new job with the URLs from the tools/index-archive databases of
+# previous crawls, listed from the oldest to the newest. Comparing the
+# payload digests between crawls is what tells us which pages change often.
+# URLs that were a 5x or blocked in every crawl aren't seeded. WARC_DEDUP_SEED_INDEX
+# can be pointed at the newest index too, so unchanged pages are written as revisits.
+RECRAWL_INDEX = []
+
+# 2x pages that were captured more recently than this (in secs) aren't
+# seeded. A page's staleness grows until its capture is RECRAWL_MAX_AGE old.
+RECRAWL_MIN_AGE = 86400  # 1 day
+RECRAWL_MAX_AGE = 90 * 86400  # 90 days
+
+# Priority given to a seeded page with the highest score (most volatile and
+# most stale), newly discovered links start at 0
+RECRAWL_PRIORITY = 100
+
+# URLs that will never be crawled. Rules are URL prefixes by default, or can
+# be written as "glob:<pattern>" or "re:<regex>" (see mozz_archiver/urlrules.py)
 URL_DENY_LIST = []
+
+# Optional file with more deny rules, one per line. Blank lines and lines
+# starting with "#" are skipped. The file is checked for changes every
+# URL_DENY_RELOAD_INTERVAL seconds (0 to only load it at startup).
+URL_DENY_FILE = None
+URL_DENY_RELOAD_INTERVAL = 30
+
+# Detect crawler traps (CGI scripts, calendars, git frontends, relative link
+# loops) that would otherwise generate an endless number of URLs
+TRAP_DETECTION_ENABLED = True
+
+# URLs deeper than this many directories are dropped
+TRAP_MAX_DEPTH = 20
+
+# URLs with a path segment repeated more than this many times are dropped
+TRAP_MAX_SEGMENT_REPEATS = 2
+
+# Quarantine a path once it has been linked to with more query strings than this
+TRAP_MAX_QUERY_VARIANTS = 100
+
+# Quarantine a directory once more than TRAP_MAX_SIMILAR_PAGES of its gemtext
+# pages were within TRAP_SIMILARITY_DISTANCE bits (of a 64-bit simhash) of a
+# page recently crawled from the same directory
+TRAP_MAX_SIMILAR_PAGES = 50
+TRAP_SIMILARITY_DISTANCE = 6
+
+# Quarantine a directory once this many prefixes inside of it have been
+# quarantined (the root directory of a host is never quarantined)
+TRAP_MAX_QUARANTINED_CHILDREN = 3
+
+# What to do with new requests under a quarantined prefix, either "demote" to
+# lower their priority by TRAP_DEMOTE_PRIORITY, or "drop"
+TRAP_ACTION = 'demote'
+TRAP_DEMOTE_PRIORITY = 1000
+
+# Max number of paths and directories to keep track of at once
+TRAP_MAX_TRACKED = 100_000
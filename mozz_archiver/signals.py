@@ -0,0 +1,24 @@
+"""
+Signals that are sent by mozz_archiver components, in addition to the
+built-in scrapy signals.
+"""
+
+# Sent after the records for a response have been written to a WARC file.
+#
+# Args: request, response, record (the warcio response record), filename,
+#       offset, length (the byte range of the response record in the file,
+#       these are None when the WARC is being written to stdout),
+#       revisit_of (when the payload was a duplicate and the record is a
+#       "revisit", a dict with the uri, date, filename, offset, length and
+#       payload_length of the original record, otherwise None)
+#
+# Records are written on background threads, but the signal is always sent
+# from the reactor thread. The last records are sent during engine_stopped.
+warc_record_written = object()
+
+# Sent when a component rejects a request before it's added to the scheduler
+# queue (e.g. a URL that's forbidden by a robots.txt that was already loaded),
+# so it never reaches the downloader middleware.
+#
+# Args: request, exception (an IgnoreRequest with the reason), spider
+request_rejected = object()
@@ -0,0 +1,236 @@
+import logging
+import time
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+
+from .robots import PersistentRobotsTxtMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+class HostState:
+    """
+    The throttle settings and recent history for a single download slot.
+    """
+
+    __slots__ = ('delay', 'concurrency', 'latency', 'error_rate', 'healthy', 'crawl_delay')
+
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.latency = None
+        self.error_rate = 0.0
+        self.healthy = 0
+        self.crawl_delay = None
+
+    def to_dict(self):
+        return {
+            'delay': round(self.delay, 3),
+            'concurrency': self.concurrency,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+        }
+
+
+class AdaptiveThrottle:
+    """
+    Downloader middleware that tunes the delay and concurrency of each host.
+
+    Every host starts out at DOWNLOAD_DELAY and CONCURRENT_REQUESTS_PER_DOMAIN.
+    From there, the controller works like TCP congestion control:
+
+    - The delay follows the host's average response time divided by its
+      concurrency, so a server is never asked to handle more requests than it
+      has been able to keep up with.
+    - Hosts that respond quickly and without errors slowly gain concurrency,
+      up to THROTTLE_MAX_CONCURRENCY.
+    - Errors, timeouts and 4x responses cut the concurrency in half and double
+      the delay.
+    - A "44 SLOW DOWN" response drops the host to a single connection and
+      waits for at least as long as the server asked for.
+
+    The delay never drops below THROTTLE_MIN_DELAY or the host's robots.txt
+    crawl-delay, and never rises above THROTTLE_MAX_DELAY except when a server
+    explicitly asks for a longer wait. CONCURRENT_REQUESTS is still the
+    ceiling for the whole crawl.
+
+    The scheduler uses the get_slot_wait() hook to skip over hosts that
+    can't accept another request yet, instead of piling requests up in
+    their download slot queues.
+    """
+
+    # Smoothing factor for the moving averages of latency and error rate
+    alpha = 0.3
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('THROTTLE_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start_delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.start_concurrency = settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+        self.min_delay = settings.getfloat('THROTTLE_MIN_DELAY', 0.5)
+        self.max_delay = settings.getfloat('THROTTLE_MAX_DELAY', 60)
+        self.max_concurrency = settings.getint('THROTTLE_MAX_CONCURRENCY', 4)
+        self.target_latency = settings.getfloat('THROTTLE_TARGET_LATENCY', 1.0)
+        self.user_agent = settings.get('USER_AGENT')
+
+        self.hosts = {}
+        self._robots = None
+
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    @property
+    def downloader(self):
+        return self.crawler.engine.downloader
+
+    @property
+    def robots(self):
+        """
+        The robots.txt middleware instance, if it's enabled.
+        """
+        if self._robots is None:
+            for middleware in self.downloader.middleware.middlewares:
+                if isinstance(middleware, PersistentRobotsTxtMiddleware):
+                    self._robots = middleware
+                    break
+            else:
+                self._robots = False
+        return self._robots
+
+    def get_slot_key(self, request):
+        # The downloader saves its slot key in the meta before the request
+        # is passed to any of the middleware
+        return request.meta.get('download_slot') or urlparse_cached(request).hostname
+
+    def get_host(self, key):
+        host = self.hosts.get(key)
+        if host is None:
+            host = self.hosts[key] = HostState(self.start_delay, self.start_concurrency)
+        return host
+
+    def get_crawl_delay(self, request, host):
+        """
+        Look up the crawl-delay from the host's robots.txt, once it has been parsed.
+        """
+        if host.crawl_delay is None and self.robots:
+            host.crawl_delay = self.robots.get_crawl_delay(request, self.user_agent)
+        return host.crawl_delay or 0
+
+    def clamp_delay(self, request, host, delay):
+        min_delay = max(self.min_delay, self.get_crawl_delay(request, host))
+        return min(max(delay, min_delay), max(self.max_delay, min_delay))
+
+    def get_slot_wait(self, key):
+        """
+        Scheduler hook, return the number of seconds until the slot can start
+        another download (or infinity if it's waiting on active downloads).
+        """
+        slot = self.downloader.slots.get(key)
+        if slot is None:
+            return 0
+
+        host = self.hosts.get(key)
+        concurrency = host.concurrency if host else slot.concurrency
+        if len(slot.active) >= concurrency:
+            return float('inf')
+
+        return max(slot.lastseen + slot.delay - time.time(), 0)
+
+    def request_reached_downloader(self, request, spider):
+        key = self.get_slot_key(request)
+        self.apply(key, self.get_host(key))
+
+    def process_response(self, request, response, spider):
+        key = self.get_slot_key(request)
+        host = self.get_host(key)
+
+        status = getattr(response, 'gemini_status', '')
+        if status == '44':
+            try:
+                wait = float(response.gemini_meta)
+            except ValueError:
+                wait = 0
+            self.on_slow_down(request, host, wait)
+        elif status.startswith('4'):
+            self.on_error(request, host, timed_out=False)
+        else:
+            latency = request.meta.get('download_latency')
+            if latency is not None:
+                self.on_success(request, host, latency)
+
+        self.apply(key, host)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            # Rejected by another middleware, the host was never contacted
+            return
+
+        key = self.get_slot_key(request)
+        host = self.get_host(key)
+        self.on_error(request, host, timed_out=request.meta.get('download_timed_out', False))
+        self.apply(key, host)
+
+    def on_success(self, request, host, latency):
+        if host.latency is None:
+            host.latency = latency
+        else:
+            host.latency += self.alpha * (latency - host.latency)
+        host.error_rate *= 1 - self.alpha
+        host.healthy += 1
+
+        target_delay = host.latency / host.concurrency
+        host.delay = self.clamp_delay(request, host, (host.delay + target_delay) / 2)
+
+        if host.latency > 2 * self.target_latency and host.concurrency > 1:
+            host.concurrency -= 1
+            host.healthy = 0
+            self.stats.inc_value('throttle/concurrency_decreases')
+        elif (
+            host.healthy >= 10 * host.concurrency
+            and host.latency < self.target_latency
+            and host.error_rate < 0.1
+            and host.concurrency < self.max_concurrency
+        ):
+            host.concurrency += 1
+            host.healthy = 0
+            self.stats.inc_value('throttle/concurrency_increases')
+
+    def on_error(self, request, host, timed_out):
+        host.error_rate += self.alpha * (1 - host.error_rate)
+        host.healthy = 0
+        host.concurrency = max(host.concurrency // 2, 1)
+        host.delay = self.clamp_delay(request, host, host.delay * (4 if timed_out else 2))
+        self.stats.inc_value('throttle/backoffs')
+
+    def on_slow_down(self, request, host, wait):
+        logger.debug(f"Received 44 SLOW DOWN ({wait}s) for {request}")
+        host.healthy = 0
+        host.concurrency = 1
+        # The server's requested wait is honored even past THROTTLE_MAX_DELAY
+        host.delay = max(self.clamp_delay(request, host, host.delay * 2), wait)
+        self.stats.inc_value('throttle/slow_down_responses')
+
+    def apply(self, key, host):
+        """
+        Push the host's settings to its download slot and update the stats.
+        """
+        slot = self.downloader.slots.get(key)
+        if slot is not None:
+            slot.delay = host.delay
+            slot.concurrency = host.concurrency
+
+        slots = self.stats.get_value('throttle/slots')
+        if slots is None:
+            slots = {}
+            self.stats.set_value('throttle/slots', slots)
+        slots[key] = host.to_dict()
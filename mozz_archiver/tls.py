@@ -0,0 +1,119 @@
+import collections
+import logging
+
+from OpenSSL import SSL
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from zope.interface.declarations import implementer
+
+try:
+    from OpenSSL._util import lib as _lib
+except ImportError:
+    _lib = None
+
+logger = logging.getLogger(__name__)
+
+
+def session_reused(connection):
+    """
+    Check if the TLS handshake on the connection resumed an earlier session.
+
+    pyOpenSSL doesn't expose this, so I'm calling into the openssl binding
+    directly. Returns None if the binding isn't available in this version of
+    pyOpenSSL.
+    """
+    ssl = getattr(connection, '_ssl', None)
+    func = getattr(_lib, 'SSL_session_reused', None)
+    if ssl is None or func is None:
+        return None
+    return bool(func(ssl))
+
+
+class TLSSessionCache:
+    """
+    LRU cache of TLS sessions, keyed by (host, port).
+
+    Gemini only allows a single request per connection, so without session
+    resumption every request to a capsule pays for a full TLS handshake.
+    Handing the last session from a host back to OpenSSL lets the next
+    connection do an abbreviated handshake using a session ID (TLS 1.2) or
+    a session ticket (TLS 1.3) instead.
+    """
+
+    def __init__(self, maxsize=10_000):
+        self.maxsize = maxsize
+        self.sessions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, key):
+        session = self.sessions.get(key)
+        if session is not None:
+            self.sessions.move_to_end(key)
+        return session
+
+    def set(self, key, session):
+        if not self.maxsize or session is None:
+            return
+
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        if len(self.sessions) > self.maxsize:
+            self.sessions.popitem(last=False)
+
+    def discard(self, key):
+        self.sessions.pop(key, None)
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class GeminiClientConnectionCreator:
+    """
+    Build the client side of a TLS connection for a single gemini request.
+
+    I would use twisted's ClientTLSOptions for this, but it installs an info
+    callback on the shared OpenSSL context on every request, and it doesn't
+    provide a way to resume a session. Instead, this creates the connection
+    from a context that's shared by all requests, and sets the SNI hostname
+    and cached session on the connection object itself.
+    """
+
+    def __init__(self, hostname, context, session_cache=None, session_key=None):
+        self.hostname = hostname
+        self.context = context
+        self.session_cache = session_cache
+        self.session_key = session_key
+        self.connection = None
+
+    def clientConnectionForTLS(self, tls_protocol):
+        connection = SSL.Connection(self.context, None)
+        connection.set_app_data(tls_protocol)
+        connection.set_connect_state()
+
+        # RFC 6066 doesn't allow IP addresses to be sent as the server name
+        if not isIPAddress(self.hostname) and not isIPv6Address(self.hostname):
+            try:
+                connection.set_tlsext_host_name(self.hostname.encode('idna'))
+            except UnicodeError:
+                logger.debug(f"Unable to set SNI for invalid hostname {self.hostname}")
+
+        if self.session_cache is not None:
+            session = self.session_cache.get(self.session_key)
+            if session is not None:
+                connection.set_session(session)
+
+        self.connection = connection
+        return connection
+
+    def save_session(self):
+        """
+        Remember the connection's session so that it can be resumed next time.
+
+        This should be called after the response has been read. TLS 1.3 sends
+        session tickets after the handshake has finished, so the session
+        isn't resumable until some application data has been received.
+        """
+        if self.session_cache is None or self.connection is None:
+            return
+
+        self.session_cache.set(self.session_key, self.connection.get_session())
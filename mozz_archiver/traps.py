@@ -0,0 +1,335 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.job import job_dir
+
+from . import signals as mozz_signals
+from .urlrules import split_origin
+
+logger = logging.getLogger(__name__)
+
+
+# Only this many distinct words are used to fingerprint a page
+MAX_FINGERPRINT_WORDS = 1000
+
+# Numbers, dates and hex strings (e.g. commit hashes)
+RE_NUMBER = re.compile(rb'[0-9a-fA-F]*[0-9][0-9a-fA-F]*')
+
+
+def simhash(features):
+    """
+    Build a 64-bit simhash from a collection of byte strings.
+
+    Every bit of the fingerprint is set if it was set in the hash of more
+    than half of the features, so sets that only differ by a few features
+    end up with fingerprints that only differ by a few bits.
+    """
+    hashes = [hashlib.blake2b(feature, digest_size=8).digest() for feature in features]
+    if not hashes:
+        return None
+
+    # Transpose the bits with zip() instead of looping over each bit position
+    bits = [format(int.from_bytes(h, 'big'), '064b') for h in hashes]
+    half = len(bits) / 2
+    value = 0
+    for column in zip(*bits):
+        value = (value << 1) | (column.count('1') > half)
+    return value
+
+
+def page_fingerprint(body):
+    """
+    Fingerprint the template that a gemtext page was generated from.
+
+    The features are the distinct words on the page with all of the numbers
+    masked out, so that a calendar's months or a git log's pages look the
+    same, which the text of unrelated pages almost never does.
+    """
+    words = set(RE_NUMBER.sub(b'#', body).split())
+    if len(words) > MAX_FINGERPRINT_WORDS:
+        words = sorted(words)[:MAX_FINGERPRINT_WORDS]
+    return simhash(words)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def get_parent_prefix(prefix):
+    """
+    Return the directory above a quarantined prefix, or None at the root.
+    """
+    origin, rest = split_origin(prefix)
+    if rest.endswith('?'):
+        parent = rest[:rest.rfind('/') + 1]
+    else:
+        parent = rest[:rest.rstrip('/').rfind('/') + 1]
+    if len(parent) <= 1:
+        return None
+    return origin + parent
+
+
+def get_page_prefix(url):
+    """
+    Group URLs that are likely to have been generated by the same script.
+
+    URLs with a query are grouped by their path, and everything else is
+    grouped by its directory.
+    """
+    origin, rest = split_origin(url)
+    if origin is None:
+        return None
+    if '?' in rest:
+        return origin + rest.split('?', 1)[0] + '?'
+    return origin + (rest[:rest.rfind('/') + 1] or '/')
+
+
+class BoundedDict(collections.OrderedDict):
+    """
+    Dictionary that forgets the least recently used keys past a max size.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = self[key] = factory()
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+        else:
+            self.move_to_end(key)
+        return value
+
+
+class PrefixState:
+
+    __slots__ = ('fingerprints', 'similar')
+
+    def __init__(self):
+        self.fingerprints = collections.deque(maxlen=8)
+        self.similar = 0
+
+
+class TrapDetector:
+    """
+    Find URL spaces that never end (CGI scripts, calendars, git frontends,
+    relative link loops) and stop them from filling up the scheduler queue.
+
+    The scheduler calls should_enqueue() for every new request. URLs that
+    are nested more than TRAP_MAX_DEPTH directories deep, or that repeat the
+    same path segment more than TRAP_MAX_SEGMENT_REPEATS times, are dropped
+    outright. Two other signals will quarantine a whole URL prefix:
+
+    - A path that has been linked to with more than TRAP_MAX_QUERY_VARIANTS
+      different query strings.
+    - A directory where more than TRAP_MAX_SIMILAR_PAGES of the gemtext pages
+      were near-duplicates (by simhash) of a page that was recently crawled
+      from the same directory. The root directory of a host is skipped,
+      since a capsule's top level pages often share the same template.
+
+    Traps tend to spread out over many sibling directories (/cal/2020/1/,
+    /cal/2020/2/, ...), so once TRAP_MAX_QUARANTINED_CHILDREN prefixes in the
+    same directory have been quarantined, the directory itself is too. This
+    stops before it reaches the root of the host.
+
+    New requests under a quarantined prefix are either dropped, or have
+    their priority lowered by TRAP_DEMOTE_PRIORITY so they're only crawled
+    once the rest of the host has been, depending on TRAP_ACTION. A request
+    is only demoted once, even if it's enqueued again (e.g. to be retried).
+
+    Quarantined prefixes are appended to a traps.jsonl report in the JOBDIR,
+    which is loaded again when the crawl is resumed. The report is rewritten
+    with the number of requests that each prefix caught when the crawl ends.
+    The prefixes can be copied into the URL_DENY_LIST to block them for good.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('TRAP_DETECTION_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_depth = settings.getint('TRAP_MAX_DEPTH', 20)
+        self.max_segment_repeats = settings.getint('TRAP_MAX_SEGMENT_REPEATS', 2)
+        self.max_query_variants = settings.getint('TRAP_MAX_QUERY_VARIANTS', 100)
+        self.similarity_distance = settings.getint('TRAP_SIMILARITY_DISTANCE', 6)
+        self.max_similar_pages = settings.getint('TRAP_MAX_SIMILAR_PAGES', 50)
+        self.demote_priority = settings.getint('TRAP_DEMOTE_PRIORITY', 1000)
+        self.max_quarantined_children = settings.getint('TRAP_MAX_QUARANTINED_CHILDREN', 3)
+
+        self.action = settings.get('TRAP_ACTION', 'demote')
+        if self.action not in ('demote', 'drop'):
+            raise ValueError(f"Invalid TRAP_ACTION setting: {self.action}")
+
+        max_tracked = settings.getint('TRAP_MAX_TRACKED', 100_000)
+        self.query_variants = BoundedDict(max_tracked)
+        self.prefix_states = BoundedDict(max_tracked)
+
+        # The prefix -> report entry for every quarantined prefix
+        self.quarantined = {}
+        self.quarantined_children = collections.Counter()
+
+        jobdir = job_dir(settings)
+        self.report_path = os.path.join(jobdir, 'traps.jsonl') if jobdir else None
+        self.load_report()
+
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def load_report(self):
+        if not self.report_path or not os.path.exists(self.report_path):
+            return
+
+        with open(self.report_path) as fp:
+            for line in fp:
+                entry = json.loads(line)
+                self.quarantined[entry['prefix']] = entry
+        if self.quarantined:
+            logger.info(f"Loaded {len(self.quarantined)} quarantined URL prefixes")
+
+    def spider_closed(self, spider):
+        self.stats.set_value('traps/quarantined', len(self.quarantined))
+        if not self.quarantined:
+            return
+
+        entries = sorted(self.quarantined.values(), key=lambda e: e['requests'], reverse=True)
+        logger.info(f"Quarantined URL prefixes ({len(entries)} total):")
+        for entry in entries[:20]:
+            logger.info(f"  {entry['requests']:>8}  {entry['reason']:<8}  {entry['prefix']}")
+
+        if self.report_path:
+            tmp_path = f'{self.report_path}.tmp'
+            with open(tmp_path, 'w') as fp:
+                for entry in entries:
+                    fp.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.report_path)
+
+    def quarantine(self, prefix, reason):
+        entry = {'prefix': prefix, 'reason': reason, 'time': round(time.time()), 'requests': 0}
+        self.quarantined[prefix] = entry
+        self.stats.inc_value(f'traps/quarantined/{reason}')
+        logger.info(f"Quarantined URL prefix {prefix} ({reason})")
+
+        if self.report_path:
+            with open(self.report_path, 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+
+        parent = get_parent_prefix(prefix)
+        if parent and self.max_quarantined_children and parent not in self.quarantined:
+            self.quarantined_children[parent] += 1
+            if self.quarantined_children[parent] >= self.max_quarantined_children:
+                del self.quarantined_children[parent]
+                self.quarantine(parent, 'children')
+
+    def find_quarantined(self, origin, path, query):
+        """
+        Return the report entry for the quarantined prefix that the URL falls under.
+        """
+        if query:
+            entry = self.quarantined.get(f'{origin}{path}?')
+            if entry:
+                return entry
+
+        i = path.find('/')
+        while i != -1:
+            entry = self.quarantined.get(origin + path[:i + 1])
+            if entry:
+                return entry
+            i = path.find('/', i + 1)
+        return None
+
+    def reject(self, request, reason):
+        logger.debug("Forbidden by trap detector (%(reason)s): %(request)s",
+                     {'reason': reason, 'request': request}, extra={'spider': self.crawler.spider})
+        self.stats.inc_value(f'traps/dropped/{reason}')
+        self.crawler.signals.send_catch_log(
+            mozz_signals.request_rejected,
+            request=request,
+            exception=IgnoreRequest("Forbidden by trap detector"),
+            spider=self.crawler.spider,
+        )
+        return False
+
+    def should_enqueue(self, request):
+        """
+        Scheduler hook, return False to drop a request before it's queued.
+
+        Requests under a quarantined prefix may have their priority lowered.
+        """
+        origin, rest = split_origin(request.url)
+        if origin is None:
+            return True
+        path, _, query = rest.partition('?')
+
+        segments = [segment for segment in path.split('/') if segment]
+        if len(segments) > self.max_depth:
+            return self.reject(request, 'depth')
+        if len(set(segments)) < len(segments):
+            counts = collections.Counter(segments)
+            if counts.most_common(1)[0][1] > self.max_segment_repeats:
+                return self.reject(request, 'repeats')
+
+        if query and self.max_query_variants:
+            key = f'{origin}{path}?'
+            if key not in self.quarantined:
+                variants = self.query_variants.get_or_create(key, set)
+                variants.add(hash(query))
+                if len(variants) > self.max_query_variants:
+                    del self.query_variants[key]
+                    self.quarantine(key, 'queries')
+
+        entry = self.find_quarantined(origin, path, query)
+        if entry is None:
+            return True
+
+        if self.action == 'drop':
+            entry['requests'] += 1
+            return self.reject(request, entry['reason'])
+
+        if not request.meta.get('trap_demoted'):
+            entry['requests'] += 1
+            request.meta['trap_demoted'] = True
+            request.priority -= self.demote_priority
+            self.stats.inc_value('traps/demoted')
+        return True
+
+    def response_received(self, response, request, spider):
+        if not self.max_similar_pages or not getattr(response, 'is_gemini_map', False):
+            return
+
+        prefix = get_page_prefix(response.url)
+        if prefix is None or prefix in self.quarantined:
+            return
+        if split_origin(prefix)[1] == '/':
+            # Same as the "children" rule, never quarantine a whole host
+            return
+
+        fingerprint = page_fingerprint(response.body)
+        if fingerprint is None:
+            return
+
+        state = self.prefix_states.get_or_create(prefix, PrefixState)
+        for other in state.fingerprints:
+            if hamming_distance(fingerprint, other) <= self.similarity_distance:
+                state.similar += 1
+                if state.similar > self.max_similar_pages:
+                    del self.prefix_states[prefix]
+                    self.quarantine(prefix, 'similar')
+                    return
+                break
+        state.fingerprints.append(fingerprint)
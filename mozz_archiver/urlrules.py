@@ -0,0 +1,155 @@
+"""
+Compiled matcher for the URL deny list.
+
+Each rule is one of:
+
+    gemini://example.com/cgi/           A prefix of the URL
+    glob:gemini://example.com/*/git/*   The whole URL, where "*" matches anything
+    re:gemini://[^/]+/mirrors/          A regex matched from the start of the URL
+
+Prefix and glob rules that begin with a complete "scheme://netloc" are
+sharded by that origin, so a URL is only compared against the rules for its
+own host. The prefixes for a host are kept in a sorted list with the
+redundant ones removed, which can be searched with a single bisect, and the
+globs for a host are combined into one regex. Rules without a fixed origin
+are checked against every URL.
+"""
+import bisect
+import collections
+import re
+
+RE_ORIGIN = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*')
+
+
+def split_origin(url):
+    """
+    Split a URL into its "scheme://netloc" and whatever comes after it.
+    """
+    match = RE_ORIGIN.match(url)
+    if match is None:
+        return None, url
+    return match.group(), url[match.end():]
+
+
+def glob_to_regex(pattern):
+    # Only "*" is special, "?" and "[" show up in URLs way too often
+    return '.*'.join(re.escape(part) for part in pattern.split('*')) + r'\Z'
+
+
+def prune_prefixes(prefixes):
+    """
+    Sort the prefixes and drop any that start with another prefix in the list.
+
+    What's left has the property that if any of the prefixes matches a
+    string, it must be the largest prefix that sorts before the string.
+    """
+    pruned = []
+    for prefix in sorted(set(prefixes)):
+        if not pruned or not prefix.startswith(pruned[-1]):
+            pruned.append(prefix)
+    return pruned
+
+
+class PatternSet:
+    """
+    Several regex patterns, combined into one regex that tries each in turn.
+
+    The alternatives aren't wrapped in named groups, which would stop sre
+    from factoring the common prefix out of patterns like "gemini://[^/]+/"
+    and make matching several times slower. The rule that matched is only
+    looked up when there's a match.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern, _ in patterns), re.S)
+
+    def match(self, value):
+        if self.regex.match(value):
+            for pattern, rule in self.patterns:
+                if re.match(pattern, value, re.S):
+                    return rule
+        return None
+
+
+class URLRules:
+    """
+    A list of URL deny rules, compiled for matching.
+
+    Raises re.error if any of the regex rules are invalid.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        host_prefixes = collections.defaultdict(list)
+        host_globs = collections.defaultdict(list)
+        prefixes, patterns = [], []
+        self.separate_patterns = []
+
+        for rule in self.rules:
+            if rule.startswith('re:'):
+                compiled = re.compile(rule[3:], re.S)
+                if compiled.groups or compiled.flags != re.compile('', re.S).flags:
+                    # Capture groups (e.g. for backreferences) and inline flags
+                    # can't be safely merged into a larger regex.
+                    self.separate_patterns.append((compiled, rule))
+                else:
+                    patterns.append((rule[3:], rule))
+            elif rule.startswith('glob:'):
+                origin, rest = split_origin(rule[5:])
+                if origin and rest and '*' not in origin:
+                    host_globs[origin].append((glob_to_regex(rest), rule))
+                else:
+                    patterns.append((glob_to_regex(rule[5:]), rule))
+            else:
+                origin, rest = split_origin(rule)
+                if origin and rest:
+                    host_prefixes[origin].append(rest)
+                else:
+                    prefixes.append(rule)
+
+        self.prefixes = tuple(prune_prefixes(prefixes))
+        self.patterns = PatternSet(patterns) if patterns else None
+
+        self.hosts = {}
+        for origin in host_prefixes.keys() | host_globs.keys():
+            globs = host_globs.get(origin)
+            self.hosts[origin] = (
+                prune_prefixes(host_prefixes.get(origin, [])),
+                PatternSet(globs) if globs else None,
+            )
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, url):
+        """
+        Return the rule that matches the URL, or None if no rule matches.
+        """
+        origin, rest = split_origin(url)
+        host = self.hosts.get(origin)
+        if host is not None:
+            prefixes, globs = host
+            i = bisect.bisect_right(prefixes, rest)
+            if i and rest.startswith(prefixes[i - 1]):
+                return origin + prefixes[i - 1]
+            if globs is not None:
+                rule = globs.match(rest)
+                if rule is not None:
+                    return rule
+
+        if self.prefixes and url.startswith(self.prefixes):
+            i = bisect.bisect_right(self.prefixes, url)
+            return self.prefixes[i - 1]
+
+        if self.patterns is not None:
+            rule = self.patterns.match(url)
+            if rule is not None:
+                return rule
+
+        for compiled, rule in self.separate_patterns:
+            if compiled.match(url):
+                return rule
+
+        return None
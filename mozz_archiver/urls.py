@@ -0,0 +1,115 @@
+import functools
+import re
+import string
+from urllib.parse import quote, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {
+    'gemini': 1965,
+}
+
+UNRESERVED_CHARACTERS = frozenset(string.ascii_letters + string.digits + '-._~')
+
+# Characters that can appear unescaped in each URL component (RFC 3986), in
+# addition to the unreserved characters that quote() never escapes.
+SUB_DELIMS = "!$&'()*+,;="
+PATH_SAFE = SUB_DELIMS + ':@/%'
+QUERY_SAFE = SUB_DELIMS + ':@/?%'
+
+RE_PERCENT_ENCODED = re.compile('%([0-9A-Fa-f]{2})')
+
+
+def _normalize_escape(match):
+    char = chr(int(match.group(1), 16))
+    if char in UNRESERVED_CHARACTERS:
+        return char
+    return '%' + match.group(1).upper()
+
+
+def normalize_percent_encoding(value, safe):
+    """
+    Escape any characters that aren't allowed in the component, decode
+    escaped unreserved characters, and uppercase the remaining escapes.
+    """
+    value = quote(value, safe=safe)
+    if '%' in value:
+        value = RE_PERCENT_ENCODED.sub(_normalize_escape, value)
+    return value
+
+
+def remove_dot_segments(path):
+    """
+    Resolve "." and ".." path segments (RFC 3986 section 5.2.4).
+    """
+    if '.' not in path:
+        return path
+
+    output = []
+    for segment in path.split('/'):
+        if segment == '.':
+            continue
+        elif segment == '..':
+            if output:
+                output.pop()
+        else:
+            output.append(segment)
+
+    if path.startswith('/') and (not output or output[0]):
+        output.insert(0, '')
+    if path.endswith(('/.', '/..')):
+        output.append('')
+    return '/'.join(output)
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_host(host):
+    """
+    Case-fold the hostname and convert internationalized names to punycode.
+    """
+    try:
+        host = host.encode('idna').decode('ascii')
+    except UnicodeError:
+        # Invalid labels (e.g. too long) are left as they are
+        pass
+    return host.lower()
+
+
+@functools.lru_cache(maxsize=65536)
+def canonicalize_url(url):
+    """
+    Normalize a URL so that equivalent forms of it compare as equal.
+
+    This applies the syntax-based normalization from RFC 3986 section 6.2.2
+    (case, percent-encoding, dot segments) along with dropping the default
+    port, the fragment and an empty query string. An empty path is not
+    changed to "/", because gemini servers will often redirect from one to
+    the other, so both forms need to be crawled as separate URLs.
+
+    Any URL that can't be parsed is returned unchanged.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    if not parts.netloc:
+        return url
+
+    host = normalize_host(parts.hostname or '')
+    if ':' in host:
+        host = f'[{host}]'
+
+    netloc = host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f'{netloc}:{port}'
+
+    if '@' in parts.netloc:
+        userinfo = parts.netloc.rsplit('@', maxsplit=1)[0]
+        netloc = f'{userinfo}@{netloc}'
+
+    path = normalize_percent_encoding(parts.path, PATH_SAFE)
+    path = remove_dot_segments(path)
+    query = normalize_percent_encoding(parts.query, QUERY_SAFE)
+
+    return urlunsplit((scheme, netloc, path, query, ''))
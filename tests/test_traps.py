@@ -0,0 +1,133 @@
+import pytest
+from scrapy import Spider
+from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.test import get_crawler
+
+from mozz_archiver.dupefilters import GeminiDupeFilter
+from mozz_archiver.responses import GeminiResponse
+from mozz_archiver.scheduler import CommitBatcher, Scheduler
+from mozz_archiver.traps import TrapDetector, get_page_prefix, get_parent_prefix
+
+
+def make_detector(**settings):
+    settings.setdefault('TRAP_DETECTION_ENABLED', True)
+    settings.setdefault('JOBDIR', None)
+    crawler = get_crawler(settings_dict=settings)
+    crawler.stats.open_spider(None)
+    return TrapDetector(crawler)
+
+
+def make_page(url, body):
+    return GeminiResponse(url, b'20 text/gemini', body=body)
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('gemini://example.com', 'gemini://example.com/'),
+    ('gemini://example.com/', 'gemini://example.com/'),
+    ('gemini://example.com/page.gmi', 'gemini://example.com/'),
+    ('gemini://example.com/cal/2020/1', 'gemini://example.com/cal/2020/'),
+    ('gemini://example.com/search?q', 'gemini://example.com/search?'),
+])
+def test_get_page_prefix(url, expected):
+    assert get_page_prefix(url) == expected
+
+
+@pytest.mark.parametrize('prefix,expected', [
+    ('gemini://example.com/cal/2020/', 'gemini://example.com/cal/'),
+    ('gemini://example.com/cgi/search?', 'gemini://example.com/cgi/'),
+    ('gemini://example.com/cal/', None),
+    ('gemini://example.com/search?', None),
+])
+def test_get_parent_prefix(prefix, expected):
+    assert get_parent_prefix(prefix) == expected
+
+
+def test_similar_pages_quarantine_directory():
+    detector = make_detector(TRAP_MAX_SIMILAR_PAGES=3)
+    for month in range(1, 6):
+        body = f'# Calendar 2020-{month}\n=> {month + 1} Next month\n'.encode()
+        page = make_page(f'gemini://example.com/cal/2020/{month}', body)
+        detector.response_received(page, page.request, None)
+
+    assert 'gemini://example.com/cal/2020/' in detector.quarantined
+
+
+def test_similar_pages_skip_root_directory():
+    detector = make_detector(TRAP_MAX_SIMILAR_PAGES=3)
+    for n in range(1, 10):
+        body = f'# Post {n}\n=> / Back to the home page\n'.encode()
+        page = make_page(f'gemini://example.com/post-{n}.gmi', body)
+        detector.response_received(page, page.request, None)
+
+    assert not detector.quarantined
+
+
+def test_demote_once():
+    detector = make_detector(TRAP_ACTION='demote', TRAP_DEMOTE_PRIORITY=1000)
+    detector.quarantine('gemini://example.com/cal/', 'similar')
+
+    request = Request('gemini://example.com/cal/2020/1', priority=5)
+    assert detector.should_enqueue(request)
+    assert request.priority == -995
+
+    # e.g. the retry middleware enqueuing a copy of the request
+    retry = request.replace(dont_filter=True)
+    assert detector.should_enqueue(retry)
+    assert retry.priority == -995
+    assert detector.quarantined['gemini://example.com/cal/']['requests'] == 1
+
+
+def test_drop_quarantined():
+    detector = make_detector(TRAP_ACTION='drop')
+    detector.quarantine('gemini://example.com/cal/', 'similar')
+
+    assert not detector.should_enqueue(Request('gemini://example.com/cal/2020/1'))
+    assert detector.should_enqueue(Request('gemini://example.com/about.gmi'))
+
+
+class SlotKeys:
+    """
+    Stand-in for the downloader interface, the tests never start an engine.
+    """
+
+    def get_slot_key(self, request):
+        return urlparse_cached(request).hostname
+
+
+def make_scheduler(**settings):
+    settings.setdefault('TRAP_DETECTION_ENABLED', True)
+    settings.setdefault('EXTENSIONS', {'mozz_archiver.traps.TrapDetector': 100})
+    crawler = get_crawler(Spider, settings_dict=settings)
+    crawler.stats.open_spider(None)
+
+    conn = Scheduler.connect_db(':memory:')
+    batcher = CommitBatcher(conn, 0, 1000)
+    dupefilter = GeminiDupeFilter.from_settings(crawler.settings, batcher, None)
+    scheduler = Scheduler(dupefilter, conn, crawler.stats, SlotKeys(), crawler, batcher)
+    scheduler.open(Spider.from_crawler(crawler, 'test'))
+    return scheduler
+
+
+def test_scheduler_demotes_duplicate_link_once():
+    scheduler = make_scheduler(TRAP_ACTION='demote')
+    detector = next(
+        ext for ext in scheduler.crawler.extensions.middlewares if isinstance(ext, TrapDetector)
+    )
+    detector.quarantine('gemini://example.com/cal/', 'similar')
+
+    assert scheduler.enqueue_request(Request('gemini://example.com/cal/2020/1'))
+    # The same link found again on another page
+    assert not scheduler.enqueue_request(Request('gemini://example.com/cal/2020/1'))
+
+    assert detector.quarantined['gemini://example.com/cal/']['requests'] == 1
+    assert scheduler.stats.get_value('traps/demoted') == 1
+
+
+def test_scheduler_rejects_duplicate_link_once():
+    scheduler = make_scheduler(TRAP_ACTION='drop')
+    for _ in range(3):
+        assert not scheduler.enqueue_request(Request('gemini://example.com/a/a/a/a'))
+
+    assert scheduler.stats.get_value('traps/dropped/repeats') == 1
+    assert scheduler.stats.get_value('scheduler/rejected') == 1
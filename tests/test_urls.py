@@ -0,0 +1,72 @@
+import pytest
+
+from mozz_archiver.links import LinkResolver
+from mozz_archiver.urls import canonicalize_url
+
+
+@pytest.mark.parametrize('url,expected', [
+    # Scheme and host are case-insensitive, IDNA hosts are converted to punycode
+    ('GEMINI://Example.COM/Page', 'gemini://example.com/Page'),
+    ('gemini://Bücher.example/', 'gemini://xn--bcher-kva.example/'),
+    # The default port is dropped, any other port is kept
+    ('gemini://example.com:1965/a', 'gemini://example.com/a'),
+    ('gemini://example.com:1966/a', 'gemini://example.com:1966/a'),
+    # Escaped unreserved characters are decoded and other escapes uppercased
+    ('gemini://example.com/%7euser/%3f%e2', 'gemini://example.com/~user/%3F%E2'),
+    ('gemini://example.com/a b', 'gemini://example.com/a%20b'),
+    # Dot segments are resolved
+    ('gemini://example.com/a/./b/../c', 'gemini://example.com/a/c'),
+    ('gemini://example.com/a/b/..', 'gemini://example.com/a/'),
+    # An empty path and "/" are different URLs
+    ('gemini://example.com', 'gemini://example.com'),
+    ('gemini://example.com/', 'gemini://example.com/'),
+    # Fragments and empty query strings are dropped
+    ('gemini://example.com/a#frag', 'gemini://example.com/a'),
+    ('gemini://example.com/a?#frag', 'gemini://example.com/a'),
+    ('gemini://example.com/a?q#frag', 'gemini://example.com/a?q'),
+    # URLs that can't be parsed are left alone
+    ('gemini://example.com:bad/', 'gemini://example.com:bad/'),
+])
+def test_canonicalize_url(url, expected):
+    assert canonicalize_url(url) == expected
+
+
+@pytest.mark.parametrize('link,expected', [
+    ('other.gmi', 'gemini://example.com/dir/other.gmi'),
+    ('./', 'gemini://example.com/dir/'),
+    ('sub/', 'gemini://example.com/dir/sub/'),
+    ('../up.gmi', 'gemini://example.com/up.gmi'),
+    ('/abs', 'gemini://example.com/abs'),
+    ('%7euser/', 'gemini://example.com/dir/~user/'),
+    ('page.gmi#frag', 'gemini://example.com/dir/page.gmi'),
+    ('//other.org/x', 'gemini://other.org/x'),
+    ('gemini://Other.org:1965/p', 'gemini://other.org/p'),
+    ('gemini://other.org', 'gemini://other.org'),
+    ('gemini://other.org/a/../b?', 'gemini://other.org/b'),
+    # Non-gemini links are returned unchanged
+    ('https://Example.com/a', 'https://Example.com/a'),
+    ('mailto:me@example.com', 'mailto:me@example.com'),
+])
+def test_link_resolver(link, expected):
+    resolver = LinkResolver('gemini://example.com/dir/page.gmi')
+    assert resolver.resolve(link) == expected
+
+
+@pytest.mark.parametrize('base_url,link,expected', [
+    ('gemini://example.com', 'a.gmi', 'gemini://example.com/a.gmi'),
+    ('gemini://example.com', '../a.gmi', 'gemini://example.com/a.gmi'),
+    ('gemini://example.com:1965/dir/', 'a.gmi', 'gemini://example.com/dir/a.gmi'),
+    ('gemini://Bücher.example/', 'a.gmi', 'gemini://xn--bcher-kva.example/a.gmi'),
+])
+def test_link_resolver_base_url(base_url, link, expected):
+    assert LinkResolver(base_url).resolve(link) == expected
+
+
+@pytest.mark.parametrize('link', [
+    'a.gmi', '../b/', '/c/./d', '%7ee', 'gemini://example.com:1965/x/../y',
+])
+def test_link_resolver_matches_canonicalize_url(link):
+    # The fast paths must give the same result as canonicalizing the joined URL
+    resolver = LinkResolver('gemini://Example.com:1965/dir/')
+    resolved = resolver.resolve(link)
+    assert resolved == canonicalize_url(resolved)